@@ -0,0 +1,18 @@
+"""
+Benchmarks of the API on synthetic congregations.
+
+    python -m bench --sizes 100 1000 10000 --months 12
+
+Each size gets its own temporary database filled by generate.py, then
+every route of src/main.py is called through FastAPI's TestClient
+(which needs the requests package). Latency percentiles and SQL query
+counts are reported per route.
+
+    python -m bench.importtime
+
+measures the cold start of the app against bench/importtime.json, and
+
+    python -m bench.stress
+
+checks that no stale cached value survives concurrent set_report calls.
+"""
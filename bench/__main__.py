@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def run_one(args, size):
+    # the default database is ./database.sqlite, keep it off the real one
+    os.chdir(tempfile.mkdtemp(prefix="sreport-bench-"))
+
+    from fastapi.testclient import TestClient
+
+    from src.main import app
+    from src.models import db
+
+    from .run import QueryCounter, bench_size, report
+
+    client = TestClient(app, raise_server_exceptions=False)
+    info, results = bench_size(client, QueryCounter(db.default), size, args.months, args.requests, args.seed)
+    report(info, results)
+
+    return {"info": info, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the API")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="number of preachers of each run")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--requests", type=int, default=20, help="requests per route")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results in this file")
+
+    args = parser.parse_args()
+    args.json = args.json and os.path.abspath(args.json)
+
+    if len(args.sizes) == 1:
+        output = [run_one(args, args.sizes[0])]
+
+    else:
+        # one process per size: connections, caches and executor threads
+        # of the previous size must not leak into the next one
+        output = []
+
+        for size in args.sizes:
+            with tempfile.NamedTemporaryFile(suffix=".json") as fp:
+                subprocess.run([
+                    sys.executable, "-m", "bench",
+                    "--sizes", str(size),
+                    "--months", str(args.months),
+                    "--requests", str(args.requests),
+                    "--seed", str(args.seed),
+                    "--json", fp.name,
+                ], check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+                output.extend(json.load(fp))
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(output, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Synthetic congregation generator, written through the peewee models.
+"""
+
+from datetime import date
+from random import Random
+
+from peewee import chunked
+
+from src.config import MonthBase, default_working_month
+from src.models import db, Group, Tag, Preacher, PreacherTag, Report, ReportTag
+from src.rollup import rebuild
+
+
+REGULAR = "Mpisavalalana Maharitra"
+AUXILIARY = "Mpisavalalana Mpanampy"
+TAGS = (REGULAR, AUXILIARY, "Loholona", "Mpanampy")
+
+FIRSTNAMES = ("Rija", "Hery", "Fara", "Noro", "Tiana", "Mamy", "Lova", "Haja", "Voahangy", "Andry")
+LASTNAMES = ("Rakoto", "Rabe", "Randria", "Rasoa", "Razafy", "Andriana", "Ravelo", "Rajaona")
+
+ROWS_PER_INSERT = 90
+
+
+def months_until(last:MonthBase, n:int):
+    """
+    The {n} months ending with {last}, oldest first
+    """
+
+    return [mb.data for mb in MonthBase.range(last - (n - 1), last)]
+
+
+def insert(model, rows):
+    for batch in chunked(rows, ROWS_PER_INSERT):
+        model.insert_many(batch).execute()
+
+
+def generate(preachers:int, months:int=12, seed:int=0, last:MonthBase=None):
+    """
+    Fill the (empty) database with {preachers} preachers reporting for
+    the {months} months ending with {last}, the default working month if
+    None.
+
+    About 5% are regular pioneers, 10% auxiliary pioneers on some months,
+    and 90% of the preachers report each month.
+    """
+
+    rng = Random(seed)
+    month_list = months_until(last or default_working_month(), months)
+
+    with db.atomic():
+        tags = {}
+        for name in TAGS:
+            tags[name] = Tag.create(name=name, color=f"{rng.randrange(1 << 24):06x}").id
+
+        insert(Group, [{"id": n} for n in range(1, preachers // 15 + 2)])
+
+        preacher_rows, preacher_tags = [], []
+        regulars = set()
+
+        for n in range(1, preachers + 1):
+            firstname, lastname = rng.choice(FIRSTNAMES), rng.choice(LASTNAMES)
+
+            preacher_rows.append({
+                "id": n,
+                "firstname": firstname,
+                "lastname": lastname,
+                "display_name": f"{lastname} {firstname} {n}",
+
+                "phone1": f"034{rng.randrange(10 ** 7):07}",
+                "phone2": "",
+                "phone3": "",
+
+                "address": f"Lot {rng.randrange(1, 999)}",
+
+                "birth": date(rng.randrange(1940, 2015), rng.randrange(1, 13), 1),
+                "baptism": None,
+
+                "group": n // 15 + 1,
+
+                "gender": rng.random() < .55,
+            })
+
+            if rng.random() < .05:
+                regulars.add(n)
+                preacher_tags.append({"preacher": n, "tag": tags[REGULAR], "start": month_list[0], "end": None})
+
+            if rng.random() < .08:
+                preacher_tags.append({"preacher": n, "tag": tags["Loholona"], "start": None, "end": None})
+
+        insert(Preacher, preacher_rows)
+
+        report_rows, report_tags = [], []
+        report_id = 0
+
+        for month in month_list:
+            for n in range(1, preachers + 1):
+                if rng.random() > .9:
+                    continue
+
+                report_id += 1
+
+                if n in regulars:
+                    hour = rng.randrange(50, 80)
+                    report_tags.append({"report": report_id, "tag": tags[REGULAR]})
+
+                elif rng.random() < .1:
+                    hour = rng.randrange(30, 50)
+                    report_tags.append({"report": report_id, "tag": tags[AUXILIARY]})
+                    preacher_tags.append({"preacher": n, "tag": tags[AUXILIARY], "start": month, "end": month})
+
+                else:
+                    hour = rng.randrange(0, 15)
+
+                report_rows.append({
+                    "id": report_id,
+                    "preacher": n,
+                    "month": month,
+
+                    "publication": rng.randrange(0, 10),
+                    "video": rng.randrange(0, 5),
+                    "hour": hour,
+                    "visit": rng.randrange(0, 6),
+                    "study": rng.randrange(0, 3),
+
+                    "note": "",
+                })
+
+        insert(PreacherTag, preacher_tags)
+        insert(Report, report_rows)
+        insert(ReportTag, report_tags)
+
+    rebuild()
+
+    return {
+        "preachers": preachers,
+        "months": months,
+        "reports": len(report_rows),
+    }
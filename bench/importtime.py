@@ -0,0 +1,144 @@
+"""
+Cold start of the app: import time and create_app(), each run in a new
+interpreter with ``python -X importtime``.
+
+    python -m bench.importtime --runs 5
+    python -m bench.importtime --runs 5 --save   # new baseline
+
+The framework (REFERENCE) is imported first, then the app. Milliseconds
+depend on the machine, so the gate is on the share of the import spent
+on the app itself, after the framework: the command fails when it is
+more than --max-ratio times the share of bench/importtime.json, the
+baseline kept in the repository. Only the src modules are kept there.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from statistics import median
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "bench", "importtime.json")
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+REFERENCE = "fastapi"
+
+SCRIPT = """
+from time import perf_counter
+start = perf_counter()
+import {reference}
+reference = perf_counter()
+import {module} as module
+imported = perf_counter()
+module.create_app()
+print(reference - start, imported - start, perf_counter() - imported)
+"""
+
+
+def run_once(module:str):
+    """
+    Seconds to import REFERENCE, to import it and {module}, and to create
+    the app, and the cumulative import time of each module in microseconds
+    """
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT.format(module=module, reference=REFERENCE)],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+
+    modules = {}
+    for line in process.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2))
+
+    reference, imported, created = map(float, process.stdout.split())
+
+    return reference, imported, created, modules
+
+
+def measure(module:str, runs:int):
+    shares, imports, creates, modules = [], [], [], {}
+
+    for _ in range(runs):
+        reference, imported, created, cumulative = run_once(module)
+        shares.append((imported - reference) / imported)
+        imports.append(imported)
+        creates.append(created)
+
+        for name, us in cumulative.items():
+            modules.setdefault(name, []).append(us)
+
+    return {
+        "module": module,
+        "reference": REFERENCE,
+        "runs": runs,
+        "share": round(median(shares), 3),
+        "import_ms": round(median(imports) * 1000, 1),
+        "create_app_ms": round(median(creates) * 1000, 1),
+        "modules_ms": {
+            name: round(median(us) / 1000, 1)
+            for name, us in sorted(modules.items())
+            if (name == "src") or name.startswith("src.")
+        },
+    }
+
+
+def report(result, baseline=None, top:int=15):
+    def delta(name):
+        if not baseline:
+            return ""
+
+        old = baseline.get(name)
+        return f" (baseline {old:g})" if old is not None else " (new)"
+
+    print(f"import {result['reference']} and {result['module']}: {result['import_ms']:.1f} ms"
+          f"{delta('import_ms')}")
+    print(f"share of {result['module']}: {result['share']:.3f}{delta('share')}")
+    print(f"create_app(): {result['create_app_ms']:.1f} ms"
+          f"{delta('create_app_ms')}")
+
+    print(f"\n{'module':<40} {'cumulative ms':>14}")
+    heaviest = sorted(result["modules_ms"].items(), key=lambda item: -item[1])[:top]
+    old_modules = (baseline or {}).get("modules_ms", {})
+
+    for name, ms in heaviest:
+        old = old_modules.get(name)
+        print(f"{name:<40} {ms:>14.1f}" + (f"   baseline {old:.1f}" if old is not None else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.importtime", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="src.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", action="store_true", help=f"write the result to {os.path.relpath(BASELINE, ROOT)}")
+    parser.add_argument("--max-ratio", type=float, default=1.5,
+                        help="fail when the share of the app is this many times the one of the baseline")
+
+    args = parser.parse_args()
+    result = measure(args.module, args.runs)
+
+    baseline = None
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as fp:
+            baseline = json.load(fp)
+
+    report(result, baseline)
+
+    if args.save:
+        with open(BASELINE, "w") as fp:
+            json.dump(result, fp, indent=2)
+            fp.write("\n")
+
+    elif baseline and result["share"] > baseline["share"] * args.max_ratio:
+        sys.exit(
+            f"\n{args.module} takes {result['share']:.1%} of the import time, "
+            f"more than {args.max_ratio} x {baseline['share']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
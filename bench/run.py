@@ -0,0 +1,186 @@
+"""
+Drive every route through TestClient and measure it.
+"""
+
+import tempfile
+from pathlib import Path
+from random import Random
+from threading import Lock
+from time import perf_counter
+
+from src.models import db, Report, Tag
+from src.migrations import migrate
+from src.utils import CACHED_LIST
+
+from .generate import FIRSTNAMES, generate
+
+
+class QueryCounter:
+    """
+    Count the statements sent to {database}, from every thread
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self.lock = Lock()
+
+        execute_sql = database.execute_sql
+
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.count += 1
+            return execute_sql(*args, **kwargs)
+
+        database.execute_sql = counted
+
+
+def samples(preachers:int, rng:Random):
+    """
+    {(method, path): function returning (url, json body)} for the routes
+    of src/main.py
+    """
+
+    def preacher():
+        return rng.randrange(1, preachers + 1)
+
+    def report():
+        return Report.select(Report.id).order_by(Report.id.desc()).limit(1).scalar()
+
+    tag_ids = [_.id for _ in Tag.select(Tag.id)]
+
+    def get(url):
+        return lambda: (url() if callable(url) else url, None)
+
+    return {
+        ("GET", "/api/list-preacher"): get(lambda: f"/api/list-preacher?search={rng.choice('RaHeNoTi')}"),
+        ("GET", "/api/search-preacher"): get(lambda: f"/api/search-preacher?search={rng.choice(FIRSTNAMES)[:3]}"),
+        ("GET", "/api/preacher/{id}"): get(lambda: f"/api/preacher/{preacher()}"),
+        ("GET", "/api/preacher-tag/{id}"): get(lambda: f"/api/preacher-tag/{preacher()}"),
+        ("GET", "/api/preachers"): get(
+            lambda: "/api/preachers?ids=" + ",".join(str(preacher()) for _ in range(50))),
+        ("GET", "/api/report/{preacher_id}"): get(lambda: f"/api/report/{rng.choice([0, preacher()])}"),
+        ("POST", "/api/report/{preacher_id}"): lambda: (
+            f"/api/report/{preacher()}", {"hour": rng.randrange(0, 70), "study": 1}),
+        ("POST", "/api/reports"): lambda: ("/api/reports", [
+            {"preacher": n, "hour": rng.randrange(0, 70), "tags": rng.sample(tag_ids, 1)}
+            for n in rng.sample(range(1, preachers + 1), min(preachers, 100))]),
+        ("GET", "/api/report-tag/{preacher_id}"): get(lambda: f"/api/report-tag/{rng.choice([0, preacher()])}"),
+        ("POST", "/api/report-tag/{report_id}"): lambda: (
+            f"/api/report-tag/{report()}", [rng.choice(tag_ids)]),
+        ("GET", "/api/working-month"): get("/api/working-month"),
+        ("POST", "/api/working-month"): lambda: ("/api/working-month", None),
+        ("GET", "/api/list-tag"): get("/api/list-tag"),
+        ("GET", "/api/tag/{ids}"): get(lambda: "/api/tag/" + ",".join(map(str, tag_ids))),
+        ("GET", "/api/year-service"): get("/api/year-service"),
+        ("GET", "/api/service-months"): get("/api/service-months"),
+        ("GET", "/api/returned/{preacher_id}"): get(lambda: f"/api/returned/{preacher()}"),
+        ("GET", "/api/service-hour/{preacher_id}"): get(
+            lambda: f"/api/service-hour/{rng.choice([0, preacher()])}"),
+        ("GET", "/api/record-cards"): get(lambda: rng.choice([
+            "/api/record-cards",
+            "/api/record-cards?ids=" + ",".join(str(preacher()) for _ in range(10)),
+        ])),
+        ("GET", "/api/total-month"): get(lambda: rng.choice([
+            "/api/total-month",
+            f"/api/total-month?with_tag={tag_ids[0]}",
+            f"/api/total-month?with_tag={tag_ids[0]},{tag_ids[1]}",
+            f"/api/total-month?without_tag={tag_ids[0]}",
+        ])),
+        ("GET", "/api/export"): get(lambda: rng.choice([
+            "/api/export",
+            "/api/export?format=jsonl",
+        ])),
+        ("GET", "/api/cache-stats"): get("/api/cache-stats"),
+        ("GET", "/api/db-stats"): get("/api/db-stats"),
+        ("GET", "/api/metrics"): get("/api/metrics"),
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def clear_caches():
+    for cached in CACHED_LIST:
+        cached.invalidate()
+
+
+def bench_size(client, counter, preachers:int, months:int, requests:int, seed:int=0):
+    """
+    Measure every API route on a fresh database of {preachers} preachers.
+    Call it once per process, the threads of the DB executor keep their
+    connection.
+    """
+
+    db.close()
+    path = Path(tempfile.mkdtemp(prefix="sreport-bench-")) / "database.sqlite"
+    db.init(str(path))
+    migrate(db)
+    clear_caches()
+
+    start = perf_counter()
+    info = generate(preachers, months, seed)
+    info["generate"] = perf_counter() - start
+
+    rng = Random(seed)
+    routes = samples(preachers, rng)
+    results = {}
+
+    for route in client.app.routes:
+        if not route.path.startswith("/api/"):
+            continue
+
+        for method in sorted(getattr(route, "methods", None) or []):
+            if (method, route.path) not in routes:
+                results[f"{method} {route.path}"] = None  # no sample yet
+                continue
+
+            cold, warm, queries, errors = [], [], [], 0
+
+            for _ in range(requests):
+                url, body = routes[(method, route.path)]()
+
+                clear_caches()
+                before = counter.count
+                start = perf_counter()
+                response = client.request(method, url, json=body)
+                cold.append(perf_counter() - start)
+                queries.append(counter.count - before)
+
+                errors += response.status_code >= 400
+
+                start = perf_counter()
+                client.request(method, url, json=body)
+                warm.append(perf_counter() - start)
+
+            results[f"{method} {route.path}"] = {
+                "p50": percentile(cold, 50),
+                "p95": percentile(cold, 95),
+                "p99": percentile(cold, 99),
+                "warm_p50": percentile(warm, 50),
+                "queries": max(queries),
+                "errors": errors,
+            }
+
+    return info, results
+
+
+def report(info, results):
+    print(
+        f"\n{info['preachers']} preachers, {info['months']} months, "
+        f"{info['reports']} reports (generated in {info['generate']:.1f}s)")
+    print(
+        f"{'route':<40} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'warm ms':>8} {'queries':>8} {'errors':>8}")
+
+    for name, result in results.items():
+        if result is None:
+            print(f"{name:<40} {'no sample':>8}")
+            continue
+
+        print(
+            f"{name:<40} "
+            f"{result['p50'] * 1000:>8.2f} {result['p95'] * 1000:>8.2f} {result['p99'] * 1000:>8.2f} "
+            f"{result['warm_p50'] * 1000:>8.2f} {result['queries']:>8} {result['errors']:>8}")
@@ -0,0 +1,148 @@
+"""
+Stress test of utils.Cache: no stale value survives a concurrent write.
+
+    python -m bench.stress --preachers 2000 --readers 16 --rounds 20
+
+Reader threads call the cached totals (get_report, total_month,
+service_hour) in a loop while a writer thread saves reports with
+set_report, like the DB executor does. After each round every cached
+value must equal a fresh read of the database, the command fails
+otherwise.
+"""
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+from random import Random
+from threading import Event, Thread
+
+from peewee import fn
+
+from src.config import current_working_month
+from src.main import get_report, service_hour, set_report, total_month
+from src.migrations import migrate
+from src.models import db, PostReport, Report
+from src.rollup import COUNTERS
+
+from .generate import generate
+
+
+def fresh_totals(month, preacher_id:int=0):
+    """
+    Totals of {month} read from the reports, without any cache
+    """
+
+    reports = Report.select(*[fn.COALESCE(fn.SUM(getattr(Report, name)), 0) for name in COUNTERS]) \
+        .where(Report.month == month)
+
+    if preacher_id != 0:
+        reports = reports.where(Report.preacher == preacher_id)
+
+    return dict(zip(COUNTERS, reports.tuples().get()))
+
+
+def read_all(wm, preacher_ids):
+    get_report(0, wm)
+    total_month(wm=wm)
+    service_hour(0, wm=wm)
+
+    for preacher_id in preacher_ids:
+        get_report(preacher_id, wm)
+
+
+def stale_values(wm, preacher_ids):
+    """
+    Cached values that differ from the database, as messages
+    """
+
+    month = wm.data
+    label = wm.format("{short_month} {short_year}")
+    expected = fresh_totals(month)
+    errors = []
+
+    def check(name, got, want):
+        if got != want:
+            errors.append(f"{name}: cached {got}, database {want}")
+
+    check("get_report(0)", {name: get_report(0, wm)[name] for name in COUNTERS}, expected)
+    check("total_month()", {name: total_month(wm=wm)[name] for name in COUNTERS}, expected)
+    check("service_hour(0)", service_hour(0, wm=wm)[label], expected["hour"])
+
+    for preacher_id in preacher_ids:
+        cached = get_report(preacher_id, wm)
+        check(f"get_report({preacher_id})", {name: cached[name] for name in COUNTERS},
+              fresh_totals(month, preacher_id))
+
+    return errors
+
+
+def stress(preachers:int, readers:int, rounds:int, writes:int, seed:int=0):
+    db.close()
+    db.init(str(Path(tempfile.mkdtemp(prefix="sreport-stress-")) / "database.sqlite"))
+    migrate(db)
+    generate(preachers, 12, seed)
+
+    rng = Random(seed)
+    wm = current_working_month()
+    preacher_ids = rng.sample(range(1, preachers + 1), min(preachers, 10))
+    failures = []
+
+    for n in range(1, rounds + 1):
+        stop = Event()
+        errors = []
+
+        def reader():
+            # wait a little between loops, or the readers starve the writer of the GIL
+            while not stop.wait(0.001):
+                try:
+                    read_all(wm, preacher_ids)
+                except Exception as e:
+                    errors.append(repr(e))
+                    return
+
+        def writer():
+            try:
+                for _ in range(writes):
+                    post_report = PostReport(**{name: rng.randrange(0, 50) for name in COUNTERS})
+                    set_report(rng.choice(preacher_ids), post_report, wm)
+            except Exception as e:
+                errors.append(repr(e))
+
+        threads = [Thread(target=reader) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+
+        writing = Thread(target=writer)
+        writing.start()
+        writing.join()
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        stale = stale_values(wm, preacher_ids)
+        print(f"round {n}: {writes} writes, {readers} readers, {len(errors)} errors, {len(stale)} stale values")
+
+        failures.extend(errors + stale)
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.stress", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--preachers", type=int, default=2000)
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--writes", type=int, default=50, help="set_report calls per round")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    failures = stress(args.preachers, args.readers, args.rounds, args.writes, args.seed)
+
+    if failures:
+        sys.exit("\n".join(failures[:20]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
 import json
+import argparse
+from time import perf_counter
 from pathlib import Path
 from pprint import pprint
 from random import randint
-from datetime import date, datetime
+from datetime import datetime
 
-from src.models import Group, Tag, Preacher, PreacherTag, Report, ReportTag
+from src import config
+from src.models import db, Group, Tag, Preacher, PreacherTag, Report, ReportTag
+from src.migrations import migrate
+from src.rollup import rebuild
 
-from peewee import IntegrityError
+from peewee import IntegrityError, chunked, fn
 
 
 import_from = Path.home() / ".es21" / "db.json"
@@ -69,11 +74,13 @@ month_short2long = {
     'dec': 'december', }
 
 
-class MonthBase(object):
+class MonthBase(config.MonthBase):
     """
-    Dynamic class for working month
+    Month of the es21 database, e.g. 'sep_2021' or '09-2021'
     """
 
+    __slots__ = ()
+
     MONTH_NAME = (
         'jan',
         'feb',
@@ -90,102 +97,38 @@ class MonthBase(object):
 
     FORMAT = '{short_month}_{year}'
 
-    def __init__(self, obj):
+    def __init__(self, obj, month=None):
         """
         :param obj: A date or str object
         """
 
-        if isinstance(obj, date):
-            self.data = obj
-
-        elif isinstance(obj, str):
+        if isinstance(obj, str):
             month, year = obj.split('_' if '_' in obj else '-')
 
-            if month.isdigit():
-                self.data = date(_int(year), _int(month), 1)  # day 1 is ignored
-            else:
-                self.data = date(
-                    year=_int(year),
-                    month=self.MONTH_NAME.index(month) + 1,
-                    day=1, )  # day 1 is ignored
-
-    @property
-    def month(self):
-        return self.data.month
-
-    @property
-    def year(self):
-        return self.data.year
-
-    def prettie(self, _format=None):
-        """
-        Return month string in requested :param _format:
-        """
+            if not month.isdigit():
+                month = self.MONTH_NAME.index(month) + 1
 
-        _format = _format or '{month} {year}'
+            obj = _int(year)
 
-        # - 1 because index start with 0
-        m = self.MONTH_NAME[self.data.month - 1]
-        y = self.data.year
-
-        return _format.format(
-            short_month=month_name.get(m),
-            month=month_short2long.get(m).title(),
-            short_year=str(y)[2:],
-            year=y
-        )
+        super().__init__(obj, _int(month) if month is not None else None)
 
-    def __str__(self):
+    def names(self):
         # - 1 because index start with 0
-        m = self.MONTH_NAME[self.data.month - 1]
-        y = self.data.year
-
-        return self.FORMAT.format(
-            # short_month=month_name.get(m),
-            short_month=m,
-            month=month_short2long.get(m).title(),
-            short_year=str(y)[2:],
-            year=y
-        )
-
-    def __repr__(self):
-        return f'<MonthBase month: {str(self)}>'
-
-    def __sub__(self, n):
-        """
-        Use to jump {n} month behind
-        """
+        m = self.MONTH_NAME[self.month - 1]
 
-        y = self.data.year
-        m = self.data.month
+        return {
+            "short_month": month_name.get(m),
+            "month": month_short2long.get(m).title(),
+            "short_year": str(self.year)[2:],
+            "year": self.year,
+        }
 
-        if n > 0:
-            self.data = date(
-                year=y - 1 if m == 1 else y,  # last year if today is jan
-                month=m - 1 if m > 1 else 12,  # avoid month 0
-                day=1, )  # day 1 is ignored
-
-            self - (n - 1)  # recursive until {n} reach 0
-
-        return self
-
-    def __add__(self, n):
+    def prettie(self, _format=None):
         """
-        Use to jump {n} month forward
+        Return month string in requested :param _format:
         """
 
-        y = self.data.year
-        m = self.data.month
-
-        if n > 0:
-            self.data = date(
-                year=y + 1 if m == 12 else y,  # last year if today is jan
-                month=m + 1 if m < 12 else 1,  # avoid month 0
-                day=1, )  # day 1 is ignored
-
-            self + (n - 1)  # recursive until {n} reach 0
-
-        return self
+        return self.format(_format or '{month} {year}')
 
     def new_me(self, obj=None):
         if obj is not None:
@@ -194,7 +137,6 @@ class MonthBase(object):
             return MonthBase(self.data)
 
 
-
 def rand_color():
     result = hex(randint(0, 16777215)).split("x")[1]
 
@@ -257,21 +199,13 @@ def auxiler(p, preacher, auxiliar):
 
         if preacher["id"] in ak["mpitory"]:
             start_month = MonthBase(ak["volana"])
-            end_month = MonthBase(ak["volana"]) + 1
+            end_month = start_month + 1
             PreacherTag.create(
                 preacher = p,
                 tag = Tag.get(Tag.name == "Mpisavalalana Mpanampy"),
 
-                start = date(
-                    year=start_month.year,
-                    month=start_month.month,
-                    day=1,
-                ),
-                end = date(
-                    year=end_month.year,
-                    month=end_month.month,
-                    day=1,
-                )
+                start = start_month.data,
+                end = end_month.data,
             )
 
 
@@ -284,11 +218,7 @@ def create_report(p, preacher):
 
         r = Report.create(
             preacher = p,
-            month = date(
-                year=month.year,
-                month=month.month,
-                day=1,
-            ),
+            month = month.data,
 
             publication = current_report["zavatra_napetraka"],
             video = current_report["video"],
@@ -358,8 +288,301 @@ def create_preacher(preacher, n, auxiliar):
         print(e)
 
 
-def main():
-    with open(import_from, "r") as fp:
+class JSONReader:
+    """
+    Incremental reader for a json file made of nested objects.
+
+    Only the record being read is kept in memory, so a large archive is
+    imported with a constant memory footprint.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fp, chunk_size=1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.fp.read(self.chunk_size)
+
+        if not chunk:
+            self.eof = True
+        else:
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+
+    def _peek(self):
+        """
+        Skip whitespaces and return the next character
+        """
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+
+            if self.eof:
+                raise ValueError("Unexpected end of json")
+
+            self._fill()
+
+    def _expect(self, char):
+        found = self._peek()
+
+        if found != char:
+            raise ValueError(f"Expected {char!r}, found {found!r}")
+
+        self.pos += 1
+
+    def value(self):
+        """
+        Decode the next json value
+        """
+
+        self._peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+
+                # a number could be cut by the end of the buffer
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self._fill()
+
+    def keys(self):
+        """
+        Iterate over the keys of the next json object.
+        The value of each key must be read before asking the next one.
+        """
+
+        self._expect("{")
+
+        if self._peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self._expect(":")
+
+            yield key
+
+            separator = self._peek()
+            self.pos += 1
+
+            if separator == "}":
+                return
+            elif separator != ",":
+                raise ValueError(f"Expected ',' or '}}', found {separator!r}")
+
+
+def iter_table(path, name):
+    """
+    Stream the records of the TinyDB table {name}
+    """
+
+    with open(path, "r") as fp:
+        reader = JSONReader(fp)
+
+        for table in reader.keys():
+            for key in reader.keys():
+                record = reader.value()
+
+                if table == name:
+                    yield record
+
+
+class BulkImporter:
+    """
+    Import preachers with insert_many() in batched transactions.
+
+    Tags, groups and preachers already in the database are loaded once in
+    memory instead of being looked up for every row.
+    """
+
+    PIONEER_TAGS = ("Mpisavalalana Maharitra", "Mpisavalalana Mpanampy")
+
+    # insertion order, foreign keys are checked on insert
+    MODELS = (Group, Preacher, PreacherTag, Report, ReportTag)
+
+    # keep insert_many below SQLite's variable limit
+    ROWS_PER_INSERT = 90
+
+    def __init__(self, auxiliar):
+        """
+        :param auxiliar: mpanampy records, used to tag auxiliary pioneers
+        """
+
+        self.tags = {_.name: _.id for _ in Tag.select(Tag.id, Tag.name)}
+        self.groups = {_.id for _ in Group.select(Group.id)}
+        self.preacher_ids = {_.id for _ in Preacher.select(Preacher.id)}
+        self.display_names = {
+            _.display_name for _ in Preacher.select(Preacher.display_name)}
+
+        self.next_report_id = (Report.select(fn.MAX(Report.id)).scalar() or 0) + 1
+
+        # preacher id -> months as auxiliary pioneer
+        self.auxiliar = {}
+        for ak in auxiliar:
+            for preacher_id in ak["mpitory"]:
+                self.auxiliar.setdefault(preacher_id, []).append(ak["volana"])
+
+        self.rows = {model: [] for model in self.MODELS}
+        self.inserted = 0
+
+        for name in self.PIONEER_TAGS:
+            self.tag_id(name)
+
+    def tag_id(self, name):
+        if name not in self.tags:
+            self.tags[name] = Tag.create(name=name, color=rand_color()).id
+
+        return self.tags[name]
+
+    def add(self, preacher, n):
+        display_name = preacher.get("anarana_feno", "")
+
+        if display_name == "":
+            display_name = f'{preacher["anarana"]} {preacher["fanampinanarana"]}'
+
+        if (n in self.preacher_ids) or (display_name in self.display_names):
+            print(f"Skip {n} {display_name}: already imported")
+            return
+
+        self.preacher_ids.add(n)
+        self.display_names.add(display_name)
+
+        if preacher["groupe"] not in self.groups:
+            self.groups.add(preacher["groupe"])
+            self.rows[Group].append({"id": preacher["groupe"]})
+
+        self.rows[Preacher].append({
+            "id": n,
+            "firstname": preacher["fanampinanarana"],
+            "lastname": preacher["anarana"],
+            "display_name": display_name,
+
+            "phone1": preacher["finday"][0],
+            "phone2": preacher["finday"][1],
+            "phone3": preacher["finday"][2],
+
+            "address": preacher["adiresy"],
+
+            "birth": convert_date(preacher["teraka"]),
+            "baptism": convert_date(preacher["batisa"]),
+
+            "group": preacher["groupe"],
+
+            "gender": 0 if preacher["lahy_sa_vavy"] == "Lahy" else 1,
+        })
+
+        if preacher["tombotsoa"]:
+            self.add_preacher_tag(n, preacher["tombotsoa"])
+
+        if preacher["maharitra"]:
+            self.add_preacher_tag(n, "Mpisavalalana Maharitra")
+
+        for volana in self.auxiliar.get(preacher["id"], []):
+            start_month = MonthBase(volana)
+            end_month = start_month + 1
+
+            self.add_preacher_tag(
+                n, "Mpisavalalana Mpanampy",
+                start=start_month.data,
+                end=end_month.data,
+            )
+
+        for key_month, current_report in preacher["tatitra"].items():
+            self.add_report(n, MonthBase(key_month), current_report)
+
+    def add_preacher_tag(self, preacher_id, name, start=None, end=None):
+        self.rows[PreacherTag].append({
+            "preacher": preacher_id,
+            "tag": self.tag_id(name),
+            "start": start,
+            "end": end,
+        })
+
+    def add_report(self, preacher_id, month, current_report):
+        report_id = self.next_report_id
+        self.next_report_id += 1
+
+        self.rows[Report].append({
+            "id": report_id,
+            "preacher": preacher_id,
+            "month": month.data,
+
+            "publication": current_report["zavatra_napetraka"],
+            "video": current_report["video"],
+            "hour": current_report["ora"],
+            "visit": current_report["fitsidihana"],
+            "study": current_report["fampianarana"],
+
+            "note": current_report["fanamarihana"],
+        })
+
+        pioneer = {
+            "Reg": "Mpisavalalana Maharitra",
+            "Aux": "Mpisavalalana Mpanampy",
+        }.get(current_report["mpisavalalana"])
+
+        if pioneer is not None:
+            self.rows[ReportTag].append({
+                "report": report_id,
+                "tag": self.tag_id(pioneer),
+            })
+
+    def flush(self):
+        for model in self.MODELS:
+            for batch in chunked(self.rows[model], self.ROWS_PER_INSERT):
+                model.insert_many(batch).execute()
+                self.inserted += len(batch)
+
+            self.rows[model] = []
+
+
+def bulk_main(path, batch_size):
+    migrate(db)
+    start = perf_counter()
+
+    importer = BulkImporter(iter_table(path, "mpanampy"))
+
+    n = 0
+    for batch in chunked(iter_table(path, "_default"), batch_size):
+        with db.atomic():
+            for preacher in batch:
+                n += 1
+                importer.add(preacher, n)
+
+            importer.flush()
+
+        print(f"{n} preachers", flush=True)
+
+    rebuild()
+
+    elapsed = perf_counter() - start
+    print(
+        f"{importer.inserted} rows in {elapsed:.2f}s "
+        f"({importer.inserted / elapsed:.0f} rows/s)")
+
+
+def main(path=import_from):
+    migrate(db)
+
+    with open(path, "r") as fp:
         loaded = json.load(fp)
 
     pprint(loaded["_default"].keys())
@@ -372,6 +595,21 @@ def main():
         create_tag(preacher)
         create_preacher(preacher, n+1, loaded["mpanampy"])
 
+    rebuild()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Import an es21 database")
+    parser.add_argument("path", nargs="?", default=import_from, type=Path)
+    parser.add_argument(
+        "--bulk", action="store_true",
+        help="batched transactions and insert_many, streaming the json")
+    parser.add_argument("--batch-size", type=int, default=200,
+                        help="preachers per transaction in bulk mode")
+
+    args = parser.parse_args()
+
+    if args.bulk:
+        bulk_main(args.path, args.batch_size)
+    else:
+        main(args.path)
@@ -0,0 +1,148 @@
+"""
+Cache invalidation across processes, for ``uvicorn --workers N``.
+
+Every write is appended to the ChangeLog table of the database written,
+in the transaction of the write (see the atomic parameter of Cache).
+Before each request, ChangesMiddleware reads, on the reader threads of
+the DB executor, the entries the other processes added since it last
+looked, and replays them on the local caches: a single indexed query when
+nothing changed. The log keeps the last CHANGES_KEEP entries, a process
+further behind drops every cached value of that database instead.
+"""
+
+import json
+from threading import Lock
+from time import monotonic
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from peewee import fn
+
+from .config import CHANGES_KEEP, CHANGES_POLL, MonthBase
+from .models import MODELS, ChangeLog
+from .utils import INSTANCE, UPDATE_LISTENERS, invalidate_caches, partition
+
+
+DEPS = {dep.__name__: dep for dep in MODELS + [MonthBase]}
+
+
+def encode(scope):
+    def value(val):
+        if isinstance(val, (set, frozenset)):
+            return [value(_) for _ in val]
+        if isinstance(val, MonthBase):
+            return val.to_dict()
+        return val
+
+    return json.dumps({dim: value(val) for dim, val in scope.items() if dim != "partition"})
+
+
+def decode(scope):
+    def value(val):
+        if isinstance(val, list):
+            return {value(_) for _ in val}
+        if isinstance(val, dict):
+            return MonthBase(val)
+        return val
+
+    return {dim: value(val) for dim, val in json.loads(scope).items()}
+
+
+def record(deps, scope):
+    """
+    Log a write of this process, in its transaction, see
+    utils.UPDATE_LISTENERS
+    """
+
+    entry = ChangeLog.create(
+        origin=INSTANCE,
+        deps=",".join(dep.__name__ for dep in deps),
+        scope=encode(scope))
+
+    if entry.id % 100 == 0:
+        ChangeLog.delete().where(ChangeLog.id <= entry.id - CHANGES_KEEP).execute()
+
+
+class Changes:
+    def __init__(self, interval:float=CHANGES_POLL):
+        self.interval = interval
+        self.seen = {}  # partition: (last ChangeLog id replayed, when)
+        self.lock = Lock()
+
+    def due(self):
+        """
+        Whether poll() would read the log of the current context
+        """
+
+        with self.lock:
+            _, when = self.seen.get(partition.get(), (None, 0))
+
+        return monotonic() - when >= self.interval
+
+    def poll(self):
+        """
+        Replay the writes of the other processes to the database of the
+        current context
+        """
+
+        key = partition.get()
+
+        with self.lock:
+            last, when = self.seen.get(key, (None, 0))
+
+            if monotonic() - when < self.interval:
+                return
+
+            if last is None:
+                # nothing of this database is cached yet
+                last = ChangeLog.select(fn.MAX(ChangeLog.id)).scalar() or 0
+                self.seen[key] = (last, monotonic())
+                return
+
+            entries = ChangeLog.select(ChangeLog.id, ChangeLog.origin, ChangeLog.deps, ChangeLog.scope) \
+                .where(ChangeLog.id > last) \
+                .order_by(ChangeLog.id) \
+                .tuples()
+            entries = list(entries)
+
+            self.seen[key] = (entries[-1][0] if entries else last, monotonic())
+
+        if entries and (entries[-1][0] - last > CHANGES_KEEP):
+            invalidate_caches(list(DEPS.values()), partition=key)
+            return
+
+        for _, origin, deps, scope in entries:
+            if origin == INSTANCE:
+                continue
+
+            deps = [DEPS[name] for name in deps.split(",") if name in DEPS]
+            invalidate_caches(deps, **decode(scope), partition=key)
+
+
+changes = Changes()
+
+UPDATE_LISTENERS.append(record)
+
+
+class ChangesMiddleware:
+    """
+    Pure ASGI middleware polling the changes before each request, on
+    {pool}: the reader pool of the DB executor. Paths starting with one of
+    {skip} do not read the caches and are not held by a full pool.
+    """
+
+    def __init__(self, app, pool, changes:Changes=changes, skip:tuple=()):
+        self.app = app
+        self.pool = pool
+        self.changes = changes
+        self.skip = skip
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http") and not scope["path"].startswith(self.skip) and self.changes.due():
+            try:
+                await self.pool.run(self.changes.poll)
+            except HTTPException as e:
+                response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+                return await response(scope, receive, send)
+
+        await self.app(scope, receive, send)
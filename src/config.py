@@ -1,51 +1,121 @@
 from datetime import date
+from functools import total_ordering
 
 import calendar
+import os
 
+from .models import Setting
+from .utils import Cache
 
+
+# Database executor, see executor.py
+DB_READERS = int(os.environ.get("SREPORT_DB_READERS", 4))
+DB_MAX_QUEUE = int(os.environ.get("SREPORT_DB_MAX_QUEUE", 64))
+
+# One SQLite file per congregation, see congregations.py
+CONGREGATIONS_DIR = os.environ.get("SREPORT_CONGREGATIONS_DIR", "congregations")
+CONGREGATIONS_OPEN = int(os.environ.get("SREPORT_CONGREGATIONS_OPEN", 16))
+
+# Migrate the database when the app starts instead of only checking it
+AUTO_MIGRATE = os.environ.get("SREPORT_AUTO_MIGRATE", "") not in ("", "0")
+
+# Cache invalidation across processes, see changes.py
+CHANGES_POLL = float(os.environ.get("SREPORT_CHANGES_POLL", 0))  # seconds between two polls
+CHANGES_KEEP = int(os.environ.get("SREPORT_CHANGES_KEEP", 10000))
+
+# SQL profiler, see profiler.py
+PROFILE = os.environ.get("SREPORT_PROFILE", "") not in ("", "0")
+PROFILE_SLOW_MS = float(os.environ.get("SREPORT_PROFILE_SLOW_MS", 50))
+PROFILE_REPEAT = int(os.environ.get("SREPORT_PROFILE_REPEAT", 5))
+PROFILE_KEEP = int(os.environ.get("SREPORT_PROFILE_KEEP", 100))
+
+
+@total_ordering
 class MonthBase(object):
     """
-    Dynamic class for working month
+    A month, immutable and hashable so it can key a cache.
+
+    It is stored as one month index (year * 12 + month - 1), so moving
+    {n} months is a single addition.
     """
 
+    __slots__ = ('index',)
+
     FORMAT = '{month} {year}'
 
-    def __init__(self, obj=None, mutable=True):
+    def __init__(self, obj=None, month=None):
         """
-        :param obj: A date object
+        :param obj: A date, a {"year", "month"} dict, anything with year and
+            month attributes, a 'YYYY-MM[-DD]' string or a year if {month}
+            is given. None for the current month.
+        :raise ValueError: if the month is not 1 to 12
         """
-        self.mutable = mutable
 
-        if obj is not None:
-            if isinstance(obj, date):
-                self.data = obj
-            elif isinstance(obj, dict):
-                self.data = date(obj["year"], obj["month"], 1)
+        if obj is None:
+            obj = date.today()
+
+        if month is not None:
+            year = obj
+        elif isinstance(obj, dict):
+            year, month = obj["year"], obj["month"]
+        elif isinstance(obj, str):
+            year, month = obj.split("-")[:2]
         else:
-            self.data = date.today()
+            year, month = obj.year, obj.month
+
+        month = int(month)
+
+        if not 1 <= month <= 12:
+            raise ValueError(f"month must be 1 to 12, not {month}")
+
+        object.__setattr__(self, 'index', int(year) * 12 + month - 1)
+
+    @classmethod
+    def from_index(cls, index):
+        mb = cls.__new__(cls)
+        object.__setattr__(mb, 'index', index)
+
+        return mb
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
 
     @property
     def month(self):
-        return self.data.month
+        return self.index % 12 + 1
 
     @property
     def year(self):
-        return self.data.year
+        return self.index // 12
 
-    def __str__(self):
-        m = calendar.month_name[self.data.month]
-        sm = calendar.month_abbr[self.data.month]
-        y = self.data.year
+    @property
+    def data(self):
+        """
+        First day of the month
+        """
+
+        return date(self.year, self.month, 1)
+
+    def names(self):
+        """
+        Keywords available to format()
+        """
 
-        return self.FORMAT.format(
-            short_month=sm.title(),
-            month=m.title(),
-            short_year=str(y)[2:],
-            year=y
-        )
+        return {
+            "month": calendar.month_name[self.month].title(),
+            "short_month": calendar.month_abbr[self.month].title(),
+            "short_year": str(self.year)[2:],
+            "year": self.year,
+        }
+
+    def format(self, _format=None):
+        return (_format or self.FORMAT).format(**self.names())
+
+    def __str__(self):
+        return self.format()
 
     def __repr__(self):
-        return f'<MonthBase month: {str(self)}>'
+        return f'<{type(self).__name__} month: {str(self)}>'
 
     def to_dict(self):
         return {
@@ -53,70 +123,91 @@ class MonthBase(object):
             "year": self.year,
         }
 
-    def __sub__(self, n):
+    def __eq__(self, other):
+        if not isinstance(other, MonthBase):
+            return NotImplemented
+
+        return self.index == other.index
+
+    def __lt__(self, other):
+        if not isinstance(other, MonthBase):
+            return NotImplemented
+
+        return self.index < other.index
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __add__(self, n):
         """
-        Use to jump {n} month behind
+        Use to jump {n} month forward
         """
 
-        y = self.data.year
-        m = self.data.month
+        return self.from_index(self.index + n)
 
-        if self.mutable:
+    def __sub__(self, other):
+        """
+        Use to jump {n} month behind, or count the months since {other}
+        """
 
-            if n > 0:
-                self.data = date(
-                    year=y - 1 if m == 1 else y,  # last year if today is jan
-                    month=m - 1 if m > 1 else 12,  # avoid month 0
-                    day=1, )  # day 1 is ignored
+        if isinstance(other, MonthBase):
+            return self.index - other.index
 
-                self - (n - 1)  # recursive until {n} reach 0
+        return self.from_index(self.index - other)
 
-            return self
-        else:
-            new_date = date(year=y, month=m, day=1)
+    @classmethod
+    def range(cls, first, last):
+        """
+        Every month from {first} to {last}, both included
+        """
 
-            while n > 0:
-                new_date = date(
-                    year=new_date.year - 1 if new_date.month == 1 else new_date.year,  # last year if today is jan
-                    month=new_date.month - 1 if new_date.month > 1 else 12,  # avoid month 0
-                    day=1, )  # day 1 is ignored
+        return [cls.from_index(index) for index in range(first.index, last.index + 1)]
 
-                n -= 1
+    @property
+    def service_year(self):
+        """
+        Service years run from september to august, named by their end
+        """
 
-            return MonthBase(new_date, mutable=False)
+        return self.year + 1 if self.month >= 9 else self.year
 
-    def __add__(self, n):
+    def service_months(self):
         """
-        Use to jump {n} month forward
+        The 12 months of the service year of this month
         """
 
-        y = self.data.year
-        m = self.data.month
+        first = type(self)(self.service_year - 1, 9)
 
-        if self.mutable:
+        return self.range(first, first + 11)
 
-            if n > 0:
-                self.data = date(
-                    year=y + 1 if m == 12 else y,  # last year if today is jan
-                    month=m + 1 if m < 12 else 1,  # avoid month 0
-                    day=1, )  # day 1 is ignored
 
-                self + (n - 1)  # recursive until {n} reach 0
+def default_working_month():
+    """
+    The month before this one, until a working month is set
+    """
 
-            return self
-        else:
-            new_date = date(year=y, month=m, day=1)
+    return MonthBase() - 1
 
-            while n > 0:
-                new_date = date(
-                    year=new_date.year + 1 if new_date.month == 12 else new_date.year,  # last year if today is jan
-                    month=new_date.month + 1 if new_date.month < 12 else 1,  # avoid month 0
-                    day=1, )  # day 1 is ignored
 
-                n -= 1
+@Cache(deps=[MonthBase], ttl=60)  # the default changes with the month
+def current_working_month():
+    """
+    Working month of the database of the context, shared by every worker
+    """
+
+    setting = Setting.get_or_none(Setting.name == "working_month")
+
+    if setting is None:
+        return default_working_month()
 
-            return MonthBase(new_date, mutable=False)
+    return MonthBase(setting.value)
 
 
-working_month = MonthBase() - 1
-static_working_month = MonthBase(working_month.data, mutable=False)
+def change_working_month(month:MonthBase):
+    """
+    The caller invalidates MonthBase, like set_working_month does
+    """
+
+    Setting.insert(name="working_month", value=month.data.isoformat()[:7]) \
+        .on_conflict_replace() \
+        .execute()
@@ -0,0 +1,253 @@
+"""
+One server for many congregations, each in its own SQLite file.
+
+A request names its congregation in the X-Congregation header or with a
+/c/{congregation} path prefix, e.g. /c/north/api/report/0, and runs with
+the models bound to CONGREGATIONS_DIR/{congregation}.sqlite and with its
+own cache partition. Requests without one use the default database. Like
+the default one, a database must be at the last schema version.
+
+At most CONGREGATIONS_OPEN databases stay open: opening one more closes
+every connection of the least recently used idle one. Opening and
+closing run on threads, never on the event loop.
+
+Run ``python -m src.congregations north south`` to create or migrate the
+databases of these congregations.
+"""
+
+import asyncio
+import os
+import re
+from collections import OrderedDict
+from threading import Lock
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from peewee import SqliteDatabase
+
+from .config import AUTO_MIGRATE, CONGREGATIONS_DIR, CONGREGATIONS_OPEN
+from .migrations import check_schema, migrate
+from .models import PRAGMAS, current_database, db, using
+from .utils import partition
+
+
+HEADER = "x-congregation"
+PREFIX = re.compile(r"^/c/([^/]+)(/.*)$")
+NAME = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+
+
+class CongregationDatabase(SqliteDatabase):
+    """
+    Keeps every connection it opens, from any thread, to close them all
+    """
+
+    def __init__(self, path:str):
+        super().__init__(path, pragmas=PRAGMAS, check_same_thread=False)
+        self.connections = []
+        self.connections_lock = Lock()
+
+    def _connect(self):
+        conn = super()._connect()
+
+        with self.connections_lock:
+            self.connections.append(conn)
+
+        return conn
+
+    def close_all(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+
+class Congregations:
+    """
+    The open databases. Opening one (checking or migrating its schema) and
+    closing one run on threads, only the bookkeeping runs on the event
+    loop, under the lock.
+    """
+
+    def __init__(self, directory:str=CONGREGATIONS_DIR, max_open:int=CONGREGATIONS_OPEN):
+        self.directory = directory
+        self.max_open = max_open
+
+        self.open = OrderedDict()  # name: [database, requests using it]
+        self.opening = {}  # name: future done once the database is opened, or failed to
+        self.lock = Lock()
+        self.closed = 0
+
+    def path(self, name:str):
+        return os.path.join(self.directory, f"{name}.sqlite")
+
+    def open_database(self, name:str):
+        """
+        Open the database of {name} and check its schema, a blocking call
+
+        :raise KeyError: if {name} has no database
+        :raise RuntimeError: if its schema is out of date
+        """
+
+        if not (NAME.match(name) and os.path.exists(self.path(name))):
+            raise KeyError(name)
+
+        database = CongregationDatabase(self.path(name))
+        for hook in db.hooks:
+            hook(database)
+
+        try:
+            with using(database):
+                if AUTO_MIGRATE:
+                    migrate(database)
+                else:
+                    check_schema(database)
+        except BaseException:
+            database.close_all()
+            raise
+
+        return database
+
+    async def acquire(self, name:str, pool):
+        """
+        Database of {name}, held until release(name). It is opened on
+        {pool}, the reader pool of the DB executor.
+
+        :raise KeyError: if {name} has no database
+        :raise RuntimeError: if its schema is out of date
+        :raise HTTPException: 503 if {pool} is full
+        """
+
+        while True:
+            with self.lock:
+                entry = self.open.get(name)
+
+                if entry is not None:
+                    self.open.move_to_end(name)
+                    entry[1] += 1
+                    break
+
+                opening = self.opening.get(name)
+                leader = opening is None
+                if leader:
+                    opening = self.opening[name] = asyncio.get_running_loop().create_future()
+
+            if not leader:
+                # opened by another request meanwhile, or failed: look again
+                await opening
+                continue
+
+            try:
+                database = await pool.run(self.open_database, name)
+
+                with self.lock:
+                    entry = self.open[name] = [database, 1]
+            finally:
+                with self.lock:
+                    del self.opening[name]
+                opening.set_result(None)
+
+            break
+
+        await self.close_idle()
+
+        return entry[0]
+
+    async def release(self, name:str):
+        with self.lock:
+            self.open[name][1] -= 1
+
+        await self.close_idle()
+
+    async def close_idle(self):
+        """
+        Close the least recently used databases nobody uses, over max_open
+        """
+
+        with self.lock:
+            idle = [name for name, (_, using_it) in self.open.items() if using_it == 0]
+            closing = [self.open.pop(name)[0] for name in idle[:max(0, len(self.open) - self.max_open)]]
+            self.closed += len(closing)
+
+        loop = asyncio.get_running_loop()
+        for database in closing:
+            await loop.run_in_executor(None, database.close_all)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_open": self.max_open,
+                "open": {name: using_it for name, (_, using_it) in self.open.items()},
+                "opening": sorted(self.opening),
+                "closed": self.closed,
+            }
+
+
+congregations = Congregations()
+
+
+class CongregationMiddleware:
+    """
+    Pure ASGI middleware binding the request to its congregation, whose
+    database is opened on {pool}
+    """
+
+    def __init__(self, app, pool, congregations:Congregations=congregations):
+        self.app = app
+        self.pool = pool
+        self.congregations = congregations
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        name = dict(scope["headers"]).get(HEADER.encode(), b"").decode("latin-1")
+
+        match = PREFIX.match(scope["path"])
+        if match:
+            name = match.group(1)
+            scope = dict(
+                scope,
+                path=match.group(2),
+                root_path=scope.get("root_path", "") + f"/c/{name}")
+
+        if not name:
+            return await self.app(scope, receive, send)
+
+        try:
+            database = await self.congregations.acquire(name, self.pool)
+        except KeyError:
+            response = JSONResponse({"detail": f"Unknown congregation {name}"}, status_code=404)
+            return await response(scope, receive, send)
+        except RuntimeError as e:
+            response = JSONResponse({"detail": str(e)}, status_code=503)
+            return await response(scope, receive, send)
+        except HTTPException as e:
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+            return await response(scope, receive, send)
+
+        database_token = current_database.set(database)
+        partition_token = partition.set(name)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            partition.reset(partition_token)
+            current_database.reset(database_token)
+            await self.congregations.release(name)
+
+
+if __name__ == "__main__":
+    import sys
+
+    os.makedirs(congregations.directory, exist_ok=True)
+
+    for name in sys.argv[1:]:
+        if not NAME.match(name):
+            sys.exit(f"{name}: use lowercase letters, digits, - and _")
+
+        database = SqliteDatabase(congregations.path(name), pragmas=PRAGMAS)
+
+        with using(database):
+            print(f"{name}: schema version {migrate(database)}")
+
+        database.close()
@@ -0,0 +1,183 @@
+"""
+Run the database work of async routes on dedicated threads.
+
+SQLite accepts one writer at a time, so every write goes through a single
+thread while reads are spread over a small pool. Both pools are bounded:
+when too many calls are waiting the route answers 503 at once instead of
+piling up until "database is locked".
+"""
+
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from inspect import Parameter, signature
+from threading import Lock
+
+from fastapi import HTTPException, Request, Response
+
+from .config import DB_READERS, DB_MAX_QUEUE
+from .responses import FastJSONResponse, dumps
+
+
+class Pool:
+    def __init__(self, name:str, workers:int, max_queue:int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"db-{name}")
+        self.lock = Lock()
+        self.queued = 0
+        self.running = 0
+        self.rejected = 0
+
+    def _run(self, func):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+
+        try:
+            return func()
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    async def run(self, func, *args, **kwargs):
+        with self.lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"Database {self.name} queue is full",
+                    headers={"Retry-After": "1"})
+
+            self.queued += 1
+
+        loop = asyncio.get_running_loop()
+        # the function sees the context of the request, see metrics.py
+        context = contextvars.copy_context()
+
+        return await loop.run_in_executor(
+            self.executor, context.run, self._run, partial(func, *args, **kwargs))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+
+                "queued": self.queued,
+                "running": self.running,
+                "rejected": self.rejected,
+            }
+
+
+class DBExecutor:
+    """
+    One writer thread and {readers} reader threads
+    """
+
+    def __init__(self, readers:int=DB_READERS, max_queue:int=DB_MAX_QUEUE):
+        self.reader = Pool("read", readers, max_queue)
+        self.writer = Pool("write", 1, max_queue)
+
+    def stats(self):
+        return {
+            "read": self.reader.stats(),
+            "write": self.writer.stats(),
+        }
+
+
+def if_none_match(request:Request):
+    """
+    Entity tags of the If-None-Match header, weak or not
+    """
+
+    header = request.headers.get("if-none-match", "")
+
+    return {tag.strip().replace("W/", "", 1) for tag in header.split(",") if tag.strip()}
+
+
+class DBRoutes:
+    """
+    Like app.get / app.post but the route is async and the function runs
+    on the database executor: GET on the readers, POST on the writer.
+
+    A cached GET answers with an ETag made from the versions of its deps
+    and its arguments, and with 304 Not Modified, without running the
+    function, when the client already has it: If-None-Match must name
+    that ETag, "*" is not enough to skip the function. With
+    response_class=FastJSONResponse it sends the JSON bytes kept next to
+    the cache entry.
+
+    The decorated function itself is returned untouched, so it can still
+    be called (and cached) synchronously from other functions. Routes are
+    only collected here, include() adds them to an app.
+    """
+
+    def __init__(self, executor:DBExecutor):
+        self.executor = executor
+        self.routes = []  # (method, path, kwargs, endpoint)
+
+    def include(self, app):
+        for method, path, kwargs, endpoint in self.routes:
+            getattr(app, method)(path, **kwargs)(endpoint)
+
+    def route(self, pool:Pool, method:str, path:str, kwargs:dict, conditional:bool=False):
+        def decorator(func):
+            cache = getattr(func, "cache", None) if conditional else None
+            response_class = kwargs.get("response_class")
+            encoded = isinstance(response_class, type) and issubclass(response_class, FastJSONResponse)
+
+            if cache is None:
+                @wraps(func)
+                async def endpoint(*args, **kwargs):
+                    return await pool.run(func, *args, **kwargs)
+
+            else:
+                @wraps(func)
+                async def endpoint(_request:Request, _response:Response, **kwargs):
+                    etag = cache.etag(kwargs=kwargs)
+                    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+                    tags = if_none_match(_request)
+                    if etag in tags:
+                        return Response(status_code=304, headers=headers)
+
+                    if encoded:
+                        content = await pool.run(cache.encoded, dumps, **kwargs)
+                        return response_class(content, headers=headers)
+
+                    _response.headers.update(headers)
+                    return await pool.run(func, **kwargs)
+
+                # FastAPI reads the parameters from the signature
+                func_signature = signature(func)
+                endpoint.__signature__ = func_signature.replace(parameters=[
+                    *func_signature.parameters.values(),
+                    Parameter("_request", Parameter.KEYWORD_ONLY, annotation=Request),
+                    Parameter("_response", Parameter.KEYWORD_ONLY, annotation=Response),
+                ])
+
+            self.routes.append((method, path, kwargs, endpoint))
+            return func
+
+        return decorator
+
+    def get(self, path:str, **kwargs):
+        return self.route(self.executor.reader, "get", path, kwargs, conditional=True)
+
+    def post(self, path:str, **kwargs):
+        return self.route(self.executor.writer, "post", path, kwargs)
+
+    def async_get(self, path:str, **kwargs):
+        """
+        For async functions, that run on the event loop as they are
+        """
+
+        def decorator(func):
+            self.routes.append(("get", path, kwargs, func))
+            return func
+
+        return decorator
@@ -0,0 +1,122 @@
+"""
+Export the reports of a range of months as CSV or JSON Lines.
+
+The rows are read in keyset batches of BATCH reports ordered by (month,
+preacher), each batch on a reader thread of the database executor, and
+written out as soon as they are read. Memory stays the same whatever the
+range, and other requests get the readers between two batches.
+"""
+
+import asyncio
+import csv
+import io
+import json
+
+from fastapi import HTTPException
+from peewee import Tuple, fn
+
+from .rollup import COUNTERS
+from .models import Preacher, Report, ReportTag, Tag
+
+
+BATCH = 500
+
+COLUMNS = ("month", "preacher", "display_name", "firstname", "lastname", "group") + \
+    COUNTERS + ("note", "tags")
+
+FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+
+def batch(first, last, after=None, size:int=BATCH):
+    """
+    Up to {size} rows of the reports from {first} to {last}, dates,
+    following the (month, preacher) {after}, in the order of COLUMNS
+    """
+
+    tags = ReportTag.select(fn.json_group_array(Tag.name)) \
+        .join(Tag) \
+        .where(ReportTag.report == Report.id)
+
+    query = Report.select(
+        Report.month, Report.preacher,
+        Preacher.display_name, Preacher.firstname, Preacher.lastname, Preacher.group,
+        *[getattr(Report, name) for name in COUNTERS],
+        Report.note, tags) \
+        .join(Preacher) \
+        .where(Report.month.between(first, last)) \
+        .order_by(Report.month, Report.preacher) \
+        .limit(size)
+
+    if after is not None:
+        query = query.where(Tuple(Report.month, Report.preacher) > Tuple(*after))
+
+    return [
+        (*row, json.loads(tag_names))
+        for *row, tag_names in query.tuples().iterator()
+    ]
+
+
+def encode_csv(rows, header:bool=False):
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    if header:
+        writer.writerow(COLUMNS)
+
+    for *row, tag_names in rows:
+        writer.writerow((*row, ";".join(tag_names)))
+
+    return out.getvalue()
+
+
+def encode_jsonl(rows, header:bool=False):
+    return "".join(
+        json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+ENCODERS = {
+    "csv": encode_csv,
+    "jsonl": encode_jsonl,
+}
+
+
+async def read_batch(pool, first, last, after):
+    """
+    Wait for a free place in the queue instead of failing a started stream
+    """
+
+    while True:
+        try:
+            return await pool.run(batch, first, last, after)
+        except HTTPException as e:
+            if e.status_code != 503:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def stream(pool, first, last, _format:str="csv", rows=None):
+    """
+    Encoded chunks of the reports from {first} to {last}, one per batch
+
+    :param rows: the first batch, if already read
+    """
+
+    encode = ENCODERS[_format]
+    header = True
+
+    if rows is None:
+        rows = await read_batch(pool, first, last, None)
+
+    while True:
+        yield encode(rows, header)
+        header = False
+
+        if len(rows) < BATCH:
+            break
+
+        rows = await read_batch(pool, first, last, rows[-1][:2])
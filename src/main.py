@@ -1,104 +1,283 @@
-from datetime import date
-from functools import lru_cache
-from typing import List
+from typing import List, Union
 
-from fastapi import FastAPI, Query, Depends
+from fastapi import FastAPI, Query, Depends, HTTPException, Request
+from peewee import EXCLUDED, JOIN, chunked, fn
 from fastapi.middleware.cors import CORSMiddleware
-
-from slugify import slugify
-
-from .utils import Cache, update_cache
-from .config import MonthBase, working_month, static_working_month
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+from .utils import Cache, update_cache, cache_stats
+from .executor import DBExecutor, DBRoutes
+from .congregations import CongregationMiddleware, congregations
+from .changes import ChangesMiddleware
+from . import export, metrics, profiler
+from .responses import FastJSONResponse
+from .rollup import COUNTERS, add_to_totals, month_total, refresh_month
+from .migrations import check_schema, migrate
+from .config import (AUTO_MIGRATE, PROFILE, MonthBase, default_working_month,
+                     current_working_month, change_working_month)
 from .models import (
+    db,
     Tag,
     Preacher,
+    PreacherIndex,
     PreacherTag,
     Report,
     ReportTag,
+    MonthTotal,
     PostReport,
-    PostMonth
+    PostMonthReport,
+    PostMonth,
+    PreacherData,
+    TagData,
+    RecordCards
 )
 
 
-app = FastAPI()
-
 origins = [
     # "http://localhost:3000",
     "*",
 ]
 
+db_executor = DBExecutor()
+route = DBRoutes(db_executor)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+
+def sum_counters():
+    """
+    SUM() of every report counter, 0 when there is no report
+    """
+
+    return [
+        fn.COALESCE(fn.SUM(getattr(Report, name)), 0).alias(name)
+        for name in COUNTERS
+    ]
+
+
+def report_scope(preacher_id:int=0, wm:MonthBase=None, **kwargs):
+    """
+    Cache scope of one month of a preacher, preacher_id 0 is everybody
+    """
+
+    scope = {"month": wm}
+
+    if preacher_id != 0:
+        scope["preacher"] = preacher_id
+
+    return scope
+
+
+def report_id_scope(report_id:int, **kwargs):
+    report = Report.get(Report.id == report_id)
+
+    return {"preacher": report.preacher_id, "month": MonthBase(report.month)}
+
+
+def service_year_scope(preacher_id:int=0, wm:MonthBase=None, **kwargs):
+    scope = report_scope(preacher_id, wm)
+    scope["month"] = set(wm.service_months())
+
+    return scope
+
+
+async def working_month():
+    """
+    The working month as a parameter, so it keys the cache and the ETag
+    of the route: they follow it when its default moves to a new month
+    """
+
+    # it may read the Setting table: on the readers, not on the event loop
+    return await db_executor.reader.run(current_working_month)
 
 
-def in_month(month:int=Query(0, ge=0, le=12), year:int=Query(0, ge=0, le=9999)):
+async def in_month(month:int=Query(0, ge=0, le=12), year:int=Query(0, ge=0, le=9999)):
     if (month == 0) or (year == 0):
-        return working_month
+        return await working_month()
     else:
-        return MonthBase({"year": year, "month": month})
+        return MonthBase(year, month)
+
+
+def search_preacher_index(search:str):
+    """
+    Ids of the preachers whose names have words starting like the words
+    of {search}, best match first
+    """
+
+    query = PreacherIndex.prefix_query(search)
+
+    if not query:
+        return PreacherIndex.select(PreacherIndex.rowid).where(PreacherIndex.rowid.in_([]))
+
+    return PreacherIndex.select(PreacherIndex.rowid) \
+        .where(PreacherIndex.match(query)) \
+        .order_by(PreacherIndex.rank())
+
+
+def match_preacher(search:str):
+    return Preacher.id.in_(search_preacher_index(search))
+
+
+def projection(model, fields:list, extra:tuple=()):
+    """
+    Columns of {model} named in {fields}, id always first.
+    Names in {extra} are allowed but computed by the caller.
+    """
+
+    unknown = set(fields) - set(model._meta.fields) - set(extra)
+
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {sorted(unknown)}")
+
+    return [model.id] + [
+        model._meta.fields[name] for name in fields if name not in ("id",) + extra]
+
+
+def parse_ids(ids:str, name:str="ids"):
+    """
+    Integers of the comma separated {ids}, 400 with the others
+    """
+
+    values, invalid = [], []
+
+    for _id in ids.split(","):
+        try:
+            values.append(int(_id))
+        except ValueError:
+            invalid.append(_id)
+
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} {invalid}")
+
+    return values
+
+
+def page(query, model, limit:int, after:int, fields:str):
+    """
+    Keyset pagination of {query} by id: ids, or rows of {fields}
+    """
+
+    fields = [_ for _ in fields.split(",") if _]
+
+    query = query.select(*projection(model, fields)) \
+        .where(model.id > after) \
+        .order_by(model.id)
+
+    if limit:
+        query = query.limit(limit)
 
+    if fields:
+        return list(query.dicts())
 
-@app.get("/api/list-preacher")
+    return [_.id for _ in query]
+
+
+@route.get("/api/list-preacher", response_class=FastJSONResponse,
+           response_model=Union[List[int], List[PreacherData]])
 @Cache(deps=[Preacher])
-def list_preacher(search:str=""):
-    preachers = Preacher.select(Preacher.id)
+def list_preacher(search:str="", limit:int=Query(0, ge=0), after:int=0, fields:str=""):
+    """
+    :param limit: page size, 0 for every preacher
+    :param after: last id of the previous page
+    :param fields: comma separated fields, to get rows instead of ids
+    """
+
+    preachers = Preacher.select()
     if search:
-        preachers = preachers.where(
-            Preacher.firstname.contains(search) |
-            Preacher.lastname.contains(search) |
-            Preacher.display_name.contains(search)
-        )
+        preachers = preachers.where(match_preacher(search))
 
-    result = [_.id for _ in preachers]
-    result.sort()
+    return page(preachers, Preacher, limit, after, fields)
 
-    return result
+
+@route.get("/api/search-preacher")
+@Cache(deps=[Preacher])
+def search_preacher(search:str, limit:int=Query(10, ge=1, le=100)):
+    """
+    Type-ahead: the {limit} preacher ids matching best, best first
+    """
+
+    return [_.rowid for _ in search_preacher_index(search).limit(limit)]
 
 
-@app.get("/api/preacher/{id}")
+@route.get("/api/preacher/{id}", response_class=FastJSONResponse, response_model=PreacherData)
 @Cache(deps=[Preacher])
 def get_preacher(id:int):
     return Preacher.get(Preacher.id == id).__data__
 
 
-@app.get("/api/preacher-tag/{id}")
-@Cache(deps=[Preacher, Tag, PreacherTag])
-def get_preacher_tags(id:int):
+@route.get("/api/preacher-tag/{id}")
+@Cache(deps=[Preacher, Tag, PreacherTag, MonthBase])
+def get_preacher_tags(id:int, wm:MonthBase=Depends(working_month)):
     tags = PreacherTag.select() \
         .join(Preacher, on=(PreacherTag.preacher == Preacher.id)) \
         .join(Tag, on=(PreacherTag.tag == Tag.id)) \
         .where(PreacherTag.preacher.id == id) \
-        .where((PreacherTag.start <= working_month.data) | (PreacherTag.start == None)) \
-        .where((PreacherTag.end >= working_month.data) | (PreacherTag.end == None))
+        .where((PreacherTag.start <= wm.data) | (PreacherTag.start == None)) \
+        .where((PreacherTag.end >= wm.data) | (PreacherTag.end == None))
+
+    # tag_id, not tag.id: that would load each Tag on its own
+    return {tag.tag_id: tag.end is not None for tag in tags}
+
+
+@route.get("/api/preachers", response_class=FastJSONResponse, response_model=List[PreacherData])
+@Cache(deps=[Preacher, Tag, PreacherTag, MonthBase])
+def get_preachers(ids:str="", search:str="", fields:str="", wm:MonthBase=Depends(in_month)):
+    """
+    Many preachers with their tags of the month, in two queries.
+
+    :param ids: comma separated preacher ids, empty for all
+    :param search: like list-preacher
+    :param fields: comma separated fields to return, "tags" included.
+        Empty for every field.
+    """
+
+    fields = [_ for _ in fields.split(",") if _] or (list(Preacher._meta.fields) + ["tags"])
+    preacher_ids = parse_ids(ids) if ids else []
+
+    preachers = Preacher.select(*projection(Preacher, fields, extra=("tags",))) \
+        .order_by(Preacher.id)
+
+    if ids:
+        preachers = preachers.where(Preacher.id.in_(preacher_ids))
+    if search:
+        preachers = preachers.where(match_preacher(search))
+
+    result = list(preachers.dicts())
+
+    if "tags" in fields:
+        month = wm.data
+        tags = PreacherTag.select(PreacherTag.preacher, PreacherTag.tag, PreacherTag.end) \
+            .where(PreacherTag.preacher.in_(preachers.select(Preacher.id))) \
+            .where((PreacherTag.start <= month) | (PreacherTag.start == None)) \
+            .where((PreacherTag.end >= month) | (PreacherTag.end == None))
 
-    result_tag = [_.tag.id for _ in tags]
-    result_time = []
+        by_preacher = {_["id"]: {} for _ in result}
+        for tag in tags.dicts():
+            by_preacher[tag["preacher"]][tag["tag"]] = tag["end"] is not None
 
-    for tag in tags:
-        result_time.append(tag.end is not None)
+        for preacher in result:
+            preacher["tags"] = by_preacher[preacher["id"]]
 
-    return dict(zip(result_tag, result_time))
+    return result
 
 
-@app.get("/api/report/{preacher_id}")
-@Cache(deps=[Report, Preacher, MonthBase])
+@route.get("/api/report/{preacher_id}")
+@Cache(deps=[Report, Preacher, MonthBase], scope=report_scope)
 def get_report(preacher_id:int, wm:MonthBase=Depends(in_month)):
     """
     :param preacher_id: preacher id. 0 for all
     """
 
-    reports = Report.select() \
-        .join(Preacher, on=(Report.preacher == Preacher.id)) \
-        .where(Report.month == date(wm.year, wm.month, 1)) \
+    month = wm.data
 
     if preacher_id != 0:
-        reports = reports.where(Report.preacher == Preacher.get_by_id(preacher_id))
+        reports = Report.select() \
+            .join(Preacher, on=(Report.preacher == Preacher.id)) \
+            .where(Report.month == month) \
+            .where(Report.preacher == Preacher.get_by_id(preacher_id))
+    else:
+        # totals come from the rollup, only the ids are read here
+        reports = Report.select(Report.id) \
+            .where(Report.month == month) \
+            .order_by(Report.id)
 
     if len(reports) == 0:
         return {
@@ -126,36 +305,24 @@ def get_report(preacher_id:int, wm:MonthBase=Depends(in_month)):
             "study": report.study,
         }
     else:
-        data = {
-            "id": [],
+        total = month_total(month)
+
+        return {
+            "id": [report.id for report in reports],
             "month": wm.to_dict(),
 
-            "publication": 0,
-            "video": 0,
-            "hour": 0,
-            "visit": 0,
-            "study": 0,
+            **{name: total[name] for name in COUNTERS},
         }
 
-        for report in reports:
-            data["id"].append(report.id)
-
-            data["publication"] += report.publication
-            data["video"] += report.video
-            data["hour"] += report.hour
-            data["visit"] += report.visit
-            data["study"] += report.study
-
-        return data
 
-
-@app.post("/api/report/{preacher_id}")
-@Cache(deps=get_report.cache.deps, updates=[Report, ReportTag, Tag])
+@route.post("/api/report/{preacher_id}")
+@Cache(deps=get_report.cache.deps, updates=[Report, ReportTag, Tag], scope=report_scope, atomic=db.atomic)
 def set_report(preacher_id:int, post_report:PostReport, wm:MonthBase=Depends(in_month)):
     report_id = get_report(preacher_id, wm)["id"]
 
     if report_id != 0:
         report = Report.get(Report.id == report_id)
+        before = {name: getattr(report, name) for name in COUNTERS}
 
         report.publication = post_report.publication
         report.video = post_report.video
@@ -165,6 +332,11 @@ def set_report(preacher_id:int, post_report:PostReport, wm:MonthBase=Depends(in_
         report.note = post_report.note
 
         report.save()
+
+        tags = ReportTag.select(ReportTag.tag).where(ReportTag.report == report.id).distinct()
+        add_to_totals(
+            wm.data, [0] + [_.tag_id for _ in tags], 0,
+            {name: getattr(report, name) - before[name] for name in COUNTERS})
     else:
         report = Report.create(
             preacher=Preacher.get(Preacher.id == preacher_id),
@@ -179,6 +351,9 @@ def set_report(preacher_id:int, post_report:PostReport, wm:MonthBase=Depends(in_
             note=post_report.note,
         )
 
+        # a new report has no tag yet
+        add_to_totals(wm.data, [0], 1, {name: getattr(report, name) for name in COUNTERS})
+
     return {
         "id": report.id,
         "month": wm.to_dict(),
@@ -192,80 +367,209 @@ def set_report(preacher_id:int, post_report:PostReport, wm:MonthBase=Depends(in_
     }
 
 
-@app.get("/api/report-tag/{preacher_id}")
-@Cache(deps=([Report, Tag, ReportTag, MonthBase] + get_report.cache.deps))
-def get_report_tags(preacher_id:int, wm:MonthBase=Depends(in_month)):
+@route.get("/api/report-tag/{preacher_id}")
+@Cache(deps=([Report, Tag, ReportTag, MonthBase] + get_report.cache.deps), scope=report_scope)
+def get_report_tags(preacher_id:int, counts:bool=False, wm:MonthBase=Depends(in_month)):
     """
     :param preacher_id: preacher id. 0 for all
+    :param counts: {tag id: number of reports with it} instead of the tag ids
     """
 
-    report_id = get_report(preacher_id, wm)["id"]
+    month = wm.data
+
+    if counts and preacher_id == 0:
+        totals = MonthTotal.select(MonthTotal.tag, MonthTotal.number) \
+            .where(MonthTotal.month == month) \
+            .where(MonthTotal.tag != 0)
 
-    tags = ReportTag.select() \
+        return {_.tag: _.number for _ in totals}
+
+    tags = ReportTag.select(ReportTag.tag) \
         .join(Report, on=(ReportTag.report == Report.id)) \
-        .join(Tag, on=(ReportTag.tag == Tag.id))
+        .where(Report.month == month)
+
+    if preacher_id != 0:
+        tags = tags.where(Report.preacher == preacher_id)
+
+    if counts:
+        tags = tags.select(ReportTag.tag, fn.COUNT(Report.id.distinct()).alias("number")) \
+            .group_by(ReportTag.tag)
+
+        return {_.tag_id: _.number for _ in tags}
+
+    return [_.tag_id for _ in tags.order_by(ReportTag.id)]
+
+
+def check_exist(model, ids):
+    """
+    Raise 404 unless every id of {ids} is a {model}, in one query
+    """
+
+    ids = set(ids)
+    found = set()
+
+    for batch in chunked(ids, 500):
+        found.update(_.id for _ in model.select(model.id).where(model.id.in_(batch)))
 
-    if isinstance(report_id, int):
-        tags = tags.where(ReportTag.report.id == report_id)
+    if ids - found:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Unknown {model.__name__.lower()} {sorted(ids - found)}")
 
-    else:  # maybe a list
-        def where_or(rep_id, last=None):
-            if last is None:
-                return (ReportTag.report.id == rep_id)
+
+def replace_report_tags(tags_by_report:dict):
+    """
+    Make {report id: tag ids} the exact tag sets of these reports.
+    Only deselected (or duplicated) rows are deleted and only new ones
+    inserted. Return the number of rows changed.
+    """
+
+    wanted = {report_id: set(tags) for report_id, tags in tags_by_report.items()}
+    found = set()
+    stale = []
+
+    for batch in chunked(list(wanted), 500):
+        existing = ReportTag.select(ReportTag.id, ReportTag.report, ReportTag.tag) \
+            .where(ReportTag.report.in_(batch))
+
+        for report_tag in existing:
+            key = (report_tag.report_id, report_tag.tag_id)
+
+            if (report_tag.tag_id in wanted[report_tag.report_id]) and (key not in found):
+                found.add(key)
             else:
-                return (last | (ReportTag.report.id == rep_id))
+                stale.append(report_tag.id)
 
-        query = None
-        for rep_id in report_id:
-            query = where_or(rep_id, query)
+    for batch in chunked(stale, 500):
+        ReportTag.delete().where(ReportTag.id.in_(batch)).execute()
 
-        tags = tags.where(query)
+    missing = [
+        {"report": report_id, "tag": tag_id}
+        for report_id, tags in wanted.items()
+        for tag_id in tags
+        if (report_id, tag_id) not in found
+    ]
 
-    return [_.tag.id for _ in tags]
+    for batch in chunked(missing, 200):
+        ReportTag.insert_many(batch).execute()
 
+    return len(stale) + len(missing)
 
-@app.post("/api/report-tag/{report_id}")
-@Cache(deps=([Report, Tag, ReportTag]), updates=[ReportTag, Report])
+
+@route.post("/api/report-tag/{report_id}")
+@Cache(deps=([Report, Tag, ReportTag]), updates=[ReportTag, Report], scope=report_id_scope, atomic=db.atomic)
 def set_report_tags(report_id:int, tags:List[int]):
     """
-    :param preacher_id: preacher id. 0 for all
+    Replace the tags of a report, calling it twice changes nothing.
+    Return the tag ids of the report.
     """
 
     report = Report.get(Report.id == report_id)
+    check_exist(Tag, tags)
 
-    for tag_id in tags:
-        ReportTag.create(
-            report=report,
-            tag=Tag.get(Tag.id == tag_id),
-        )
+    before = {_.tag_id for _ in ReportTag.select(ReportTag.tag).where(ReportTag.report == report.id)}
+
+    if replace_report_tags({report.id: tags}):
+        counters = {name: getattr(report, name) for name in COUNTERS}
+
+        add_to_totals(report.month, set(tags) - before, 1, counters)
+        add_to_totals(report.month, before - set(tags), -1, {name: -value for name, value in counters.items()})
+
+    return sorted(set(tags))
+
+
+@route.post("/api/reports")
+@Cache(deps=get_report.cache.deps, updates=[Report, ReportTag, Tag], scope=report_scope, atomic=db.atomic)
+def set_reports(post_reports:List[PostMonthReport], wm:MonthBase=Depends(in_month)):
+    """
+    Create or update every report of the month in one transaction.
+
+    Tags are replaced for the reports that give them.
+    """
+
+    month = wm.data
+
+    check_exist(Preacher, [_.preacher for _ in post_reports])
+    check_exist(Tag, [tag_id for _ in post_reports for tag_id in (_.tags or [])])
+
+    rows = [{
+        "preacher": post_report.preacher,
+        "month": month,
+
+        "publication": post_report.publication,
+        "video": post_report.video,
+        "hour": post_report.hour,
+        "visit": post_report.visit,
+        "study": post_report.study,
+
+        "note": post_report.note,
+    } for post_report in post_reports]
+
+    for batch in chunked(rows, 90):
+        Report.insert_many(batch) \
+            .on_conflict(
+                conflict_target=[Report.month, Report.preacher],
+                update={
+                    getattr(Report, name): getattr(EXCLUDED, name)
+                    for name in COUNTERS + ("note",)
+                }) \
+            .execute()
+
+    report_ids = {}
+    for batch in chunked([_.preacher for _ in post_reports], 500):
+        reports = Report.select(Report.id, Report.preacher) \
+            .where(Report.month == month) \
+            .where(Report.preacher.in_(batch))
+
+        report_ids.update({_.preacher_id: _.id for _ in reports})
+
+    replace_report_tags({
+        report_ids[_.preacher]: _.tags
+        for _ in post_reports
+        if _.tags is not None
+    })
+
+    refresh_month(month)
 
-    return get_report_tags(report.preacher.id, report.month)
+    return {
+        "month": wm.to_dict(),
+        "id": report_ids,
+    }
 
 
-@app.get("/api/working-month")
+@route.get("/api/working-month")
 @Cache(deps=[MonthBase])
-def get_working_month():
-    return working_month.to_dict()
+def get_working_month(wm:MonthBase=Depends(working_month)):
+    return wm.to_dict()
 
 
-@app.post("/api/working-month")
-@Cache(deps=[MonthBase], updates=[MonthBase])
-def set_working_month(post_month:PostMonth=static_working_month.to_dict()):
-    working_month.__init__(post_month)
+@route.post("/api/working-month")
+@Cache(deps=[MonthBase], updates=[MonthBase], atomic=db.atomic)
+def set_working_month(post_month:PostMonth=None):
+    """
+    :param post_month: the month before this one if not given
+    """
+
+    post_month = post_month or default_working_month().to_dict()
+    change_working_month(MonthBase(post_month))
 
     return post_month
 
 
-@app.get("/api/list-tag")
+@route.get("/api/list-tag", response_class=FastJSONResponse,
+           response_model=Union[List[int], List[TagData]])
 @Cache(deps=[Tag])
-def list_tag():
-    result = [_.id for _ in Tag.select(Tag.id)]
-    result.sort()
+def list_tag(limit:int=Query(0, ge=0), after:int=0, fields:str=""):
+    """
+    :param limit: page size, 0 for every tag
+    :param after: last id of the previous page
+    :param fields: comma separated fields, to get rows instead of ids
+    """
 
-    return result
+    return page(Tag.select(), Tag, limit, after, fields)
 
 
-@app.get("/api/tag/{ids}")
+@route.get("/api/tag/{ids}", response_class=FastJSONResponse, response_model=List[TagData])
 @Cache(deps=[Tag])
 def get_tag(ids:str):
     result = []
@@ -275,101 +579,277 @@ def get_tag(ids:str):
     return result
 
 
-@app.get("/api/year-service")
+@route.get("/api/year-service")
 @Cache(deps=[MonthBase])
 def year_service(wm:MonthBase=Depends(in_month)):
-    if wm.month in (9, 10, 11, 12):
-        return wm.year + 1
-    else:
-        return wm.year
+    return wm.service_year
 
 
-@app.get("/api/service-months")
+@route.get("/api/service-months")
 @Cache(deps=[MonthBase])
 def list_service_months(wm:MonthBase=Depends(in_month)):
-    if wm.month in (9, 10, 11, 12):
-        result = [
-            MonthBase({"year": wm.year, "month": 9}) + n for n in range(12)
-        ]
+    return [month.to_dict() for month in wm.service_months()]
 
-    else:
-        result = [
-            MonthBase({"year": wm.year - 1, "month": 9}) + n for n in range(12)
-        ]
 
-    return list(map(lambda x: x.to_dict(), result))
-
-
-@app.get("/api/returned/{preacher_id}")
-@Cache(deps=[MonthBase] + get_report.cache.deps)
+@route.get("/api/returned/{preacher_id}")
+@Cache(deps=[MonthBase] + get_report.cache.deps, scope=report_scope)
 def returned(preacher_id:int, wm:MonthBase=Depends(in_month)):
     return get_report(preacher_id, wm)["hour"] != 0
 
 
-@app.get("/api/service-hour/{preacher_id}")
-@Cache(deps=[MonthBase] + list_service_months.cache.deps + get_report.cache.deps)
-def service_hour(preacher_id:int, wm:MonthBase=Depends(in_month)):
+@route.get("/api/service-hour/{preacher_id}")
+@Cache(deps=[MonthBase] + list_service_months.cache.deps + get_report.cache.deps, scope=service_year_scope)
+def service_hour(preacher_id:int, full:bool=False, wm:MonthBase=Depends(in_month)):
     """
     :param preacher_id: preacher id. 0 for all
+    :param full: every counter of the month instead of hours only
     """
 
-    service_months = list_service_months(wm)
+    service_months = wm.service_months()
+    start, end = service_months[0].data, service_months[-1].data
+
+    if preacher_id != 0:
+        reports = Report.select(Report.month, *sum_counters()) \
+            .where(Report.month.between(start, end)) \
+            .where(Report.preacher == preacher_id) \
+            .group_by(Report.month)
+    else:
+        reports = MonthTotal.select() \
+            .where(MonthTotal.month.between(start, end)) \
+            .where(MonthTotal.tag == 0)
 
-    def get_hour_label(month):
-        mb = MonthBase(month)
-        mb.FORMAT = "{short_month} {short_year}"
+    totals = {str(_["month"]): _ for _ in reports.dicts()}
 
-        return str(mb)
+    def get_hour_label(mb):
+        return mb.format("{short_month} {short_year}")
 
-    def get_hour_value(month):
-        return get_report(preacher_id, MonthBase(month))["hour"]
+    def get_hour_value(mb):
+        total = totals.get(str(mb.data), {})
 
-    return {get_hour_label(month): get_hour_value(month) for month in service_months}
+        if full:
+            return {name: total.get(name, 0) for name in COUNTERS}
+        else:
+            return total.get("hour", 0)
 
+    return {get_hour_label(mb): get_hour_value(mb) for mb in service_months}
 
-@app.get("/api/total-month")
-@Cache(deps=[Report, ReportTag, Tag, MonthBase])
-def total_month(with_tag:str="", without_tag:str="", wm:MonthBase=Depends(in_month)):
-    # report = Report.select() \
-    #     .join(ReportTag, on=(ReportTag.report == Report.id)) \
-    #     .join(Tag, on=(ReportTag.tag == Tag.id)) \
-    #     .where(slugify(ReportTag.tag.name) == selected)
-    reports = Report.select() \
-        .where(Report.month == date(wm.year, wm.month, 1))
-
-    def filterer(report):
-        if with_tag:
-            for report_tag in report.tags:
-                if report_tag.tag.id in [int(tag_id) for tag_id in with_tag.split(",")]:
-                    return True
-            return False
-        if without_tag:
-            for report_tag in report.tags:
-                if report_tag.tag.id in [int(tag_id) for tag_id in without_tag.split(",")]:
-                    return False
-            return True
-
-        return True
+
+@route.get("/api/record-cards", response_class=FastJSONResponse, response_model=RecordCards)
+@Cache(deps=[Report, ReportTag, Preacher, MonthBase], scope=service_year_scope)
+def get_record_cards(ids:str="", wm:MonthBase=Depends(in_month)):
+    """
+    Publisher record cards (S-21) of the service year, column by column:
+    each field holds one row per preacher of 12 values, one per month.
+
+    :param ids: comma separated preacher ids, empty for every preacher
+    """
+
+    service_months = wm.service_months()
+    first = service_months[0]
+
+    preachers = Preacher.select(Preacher.id).order_by(Preacher.id)
+    if ids:
+        preachers = preachers.where(Preacher.id.in_(parse_ids(ids)))
+
+    preacher_ids = [_.id for _ in preachers]
+    row_of = {preacher_id: n for n, preacher_id in enumerate(preacher_ids)}
 
     data = {
-        "number": 0,
+        "months": [month.to_dict() for month in service_months],
+        "preachers": preacher_ids,
 
-        "publication": 0,
-        "video": 0,
-        "hour": 0,
-        "visit": 0,
-        "study": 0,
+        **{name: [[0] * 12 for _ in preacher_ids] for name in COUNTERS},
+        "note": [[""] * 12 for _ in preacher_ids],
+        "tags": [[[] for _ in range(12)] for _ in preacher_ids],
     }
 
-    reports = list(filter(filterer, reports))
+    reports = Report.select(
+        Report.preacher, Report.month,
+        *[getattr(Report, name) for name in COUNTERS],
+        Report.note, ReportTag.tag) \
+        .join(ReportTag, JOIN.LEFT_OUTER, on=(ReportTag.report == Report.id)) \
+        .where(Report.month.between(first.data, service_months[-1].data)) \
+        .order_by(Report.preacher, Report.month)
+
+    if ids:
+        reports = reports.where(Report.preacher.in_(preacher_ids))
 
-    for report in reports:
-        data["number"] += 1
+    for preacher_id, month, *counters, note, tag_id in reports.tuples():
+        row = row_of.get(preacher_id)
+        if row is None:
+            continue
 
-        data["publication"] += report.publication
-        data["video"] += report.video
-        data["hour"] += report.hour
-        data["visit"] += report.visit
-        data["study"] += report.study
+        column = MonthBase(month) - first
+
+        for name, value in zip(COUNTERS, counters):
+            data[name][row][column] = value
+        data["note"][row][column] = note
+
+        if tag_id is not None:
+            data["tags"][row][column].append(tag_id)
 
     return data
+
+
+@route.get("/api/total-month")
+@Cache(deps=[Report, ReportTag, Tag, MonthBase], scope=report_scope)
+def total_month(with_tag:str="", without_tag:str="", wm:MonthBase=Depends(in_month)):
+    """
+    Sum every report of the month, from the rollup when it has the answer.
+
+    :param with_tag: comma separated tag ids, keep reports with any of them
+    :param without_tag: comma separated tag ids, drop reports with any of them
+    """
+
+    month = wm.data
+    with_ids = [int(tag_id) for tag_id in with_tag.split(",")] if with_tag else []
+    without_ids = [int(tag_id) for tag_id in without_tag.split(",")] if without_tag else []
+
+    # with_tag wins over without_tag, as it always did. Tag 0 of the
+    # rollup is every report, not a tag: the query answers for it.
+    if (len(with_ids) == 1) and (with_ids[0] > 0):
+        return month_total(month, with_ids[0])
+
+    if not with_ids and len(without_ids) <= 1 and all(tag_id > 0 for tag_id in without_ids):
+        total = month_total(month)
+
+        for tag_id in without_ids:
+            tagged = month_total(month, tag_id)
+            total = {name: total[name] - tagged[name] for name in total}
+
+        return total
+
+    # reports with any of several tags, the rollup can not tell
+    reports = Report.select(
+        fn.COUNT(Report.id).alias("number"),
+
+        *sum_counters()
+    ).where(Report.month == month)
+
+    def tagged(tag_ids):
+        return fn.EXISTS(
+            ReportTag.select(ReportTag.id)
+            .where(ReportTag.report == Report.id)
+            .where(ReportTag.tag.in_(tag_ids))
+        )
+
+    if with_ids:
+        reports = reports.where(tagged(with_ids))
+    else:
+        reports = reports.where(~tagged(without_ids))
+
+    return reports.dicts().get()
+
+
+@route.async_get("/api/export")
+async def export_reports(start:str="", end:str="", format:str="csv", wm:MonthBase=Depends(in_month)):
+    """
+    Stream the reports from {start} to {end}, 'YYYY-MM', as csv or jsonl.
+    Default to the service year of the working month.
+    """
+
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}, use one of {', '.join(export.FORMATS)}")
+
+    service_months = wm.service_months()
+
+    try:
+        first = (MonthBase(start) if start else service_months[0]).data
+        last = (MonthBase(end) if end else service_months[-1]).data
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Months are written YYYY-MM")
+
+    if first > last:
+        raise HTTPException(status_code=400, detail=f"start {first:%Y-%m} is after end {last:%Y-%m}")
+
+    # read the first batch now, so a full queue is still a plain 503
+    rows = await db_executor.reader.run(export.batch, first, last)
+
+    return StreamingResponse(
+        export.stream(db_executor.reader, first, last, format, rows),
+        media_type=export.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="reports-{first:%Y-%m}-{last:%Y-%m}.{format}"'})
+
+
+@route.async_get("/api/cache-stats")
+async def get_cache_stats():
+    return cache_stats()
+
+
+@route.async_get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics(request:Request):
+    return PlainTextResponse(metrics.registry.render(request.app), media_type=metrics.CONTENT_TYPE)
+
+
+@route.async_get("/api/db-stats")
+async def get_db_stats():
+    return {**db_executor.stats(), "congregations": congregations.stats()}
+
+
+if PROFILE:
+    @route.async_get("/api/debug/traces")
+    async def list_traces():
+        return profiler.traces.summaries()
+
+
+    @route.async_get("/api/debug/traces/{trace_id}")
+    async def get_trace(trace_id:int):
+        return profiler.traces.get(trace_id)
+
+
+# routes that read no cached value, see ChangesMiddleware
+NO_CACHE = ("/api/cache-stats", "/api/metrics", "/api/db-stats", "/api/debug/")
+
+
+def create_app():
+    """
+    The application. The database is not touched before the startup,
+    which only checks its schema version (see AUTO_MIGRATE).
+    """
+
+    app = FastAPI()
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # once per process, whatever the number of apps
+    if PROFILE and (profiler.instrument not in db.hooks):
+        db.instrument(profiler.instrument)
+    if metrics.instrument not in db.hooks:
+        db.instrument(metrics.instrument)
+
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.add_middleware(ChangesMiddleware, pool=db_executor.reader, skip=NO_CACHE)
+    if PROFILE:
+        app.add_middleware(profiler.ProfilerMiddleware)
+    app.add_middleware(CongregationMiddleware, pool=db_executor.reader)
+
+    route.include(app)
+
+    @app.on_event("startup")
+    def check_database():
+        if AUTO_MIGRATE:
+            migrate(db)
+        else:
+            check_schema(db)
+
+    return app
+
+
+def __getattr__(name):
+    """
+    ``uvicorn src.main:app`` creates the app on first use, importing this
+    module does not
+    """
+
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,237 @@
+"""
+Request metrics in the Prometheus text format, served on /api/metrics.
+
+MetricsMiddleware times every request and names it by its route, e.g.
+/api/report/{preacher_id}, never by its path. The statements run and the
+rows fetched are counted by the database hook of instrument(), for the
+request of the current context: the executor hands the context over to
+its threads. All of it is a few additions per request or row.
+"""
+
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from .utils import CACHED_LIST
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class RequestStats:
+    __slots__ = ("queries", "rows")
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+
+current = ContextVar("request_stats", default=None)
+
+
+class CountingCursor:
+    """
+    sqlite3 cursor counting the rows fetched into {stats}
+    """
+
+    __slots__ = ("cursor", "stats")
+
+    def __init__(self, cursor, stats:RequestStats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.stats.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def instrument(database):
+    """
+    Count the statements and rows of {database} for the current request
+    """
+
+    execute_sql = database.execute_sql
+
+    def counted(*args, **kwargs):
+        stats = current.get()
+        cursor = execute_sql(*args, **kwargs)
+
+        if stats is None:
+            return cursor
+
+        stats.queries += 1
+        return CountingCursor(cursor, stats)
+
+    database.execute_sql = counted
+
+
+class RouteMetrics:
+    __slots__ = ("buckets", "count", "sum", "statuses", "queries", "rows")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.statuses = {}
+        self.queries = 0
+        self.rows = 0
+
+    def observe(self, seconds:float, status:int, stats:RequestStats):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.queries += stats.queries
+        self.rows += stats.rows
+
+
+class Registry:
+    def __init__(self):
+        self.routes = {}  # (method, route): RouteMetrics
+        self.lock = Lock()
+
+    def observe(self, method:str, route:str, seconds:float, status:int, stats:RequestStats):
+        with self.lock:
+            metrics = self.routes.get((method, route))
+            if metrics is None:
+                metrics = self.routes[(method, route)] = RouteMetrics()
+
+            metrics.observe(seconds, status, stats)
+
+    def render(self, app):
+        """
+        Every metric, in the Prometheus text format
+        """
+
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            routes = sorted(
+                (method, route, metrics.buckets[:], metrics.count, metrics.sum,
+                 dict(metrics.statuses), metrics.queries, metrics.rows)
+                for (method, route), metrics in self.routes.items())
+
+        family("sreport_requests_total", "counter", "Requests by route and status.")
+        for method, route, _, _, _, statuses, _, _ in routes:
+            for status, count in sorted(statuses.items()):
+                lines.append(f'sreport_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+        family("sreport_request_duration_seconds", "histogram", "Request latency by route.")
+        for method, route, buckets, count, total, _, _, _ in routes:
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for le, n in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                lines.append(f'sreport_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"sreport_request_duration_seconds_sum{{{labels}}} {total}")
+            lines.append(f"sreport_request_duration_seconds_count{{{labels}}} {count}")
+
+        family("sreport_db_queries_total", "counter", "SQL statements run by route.")
+        for method, route, _, _, _, _, queries, _ in routes:
+            lines.append(f'sreport_db_queries_total{{method="{method}",route="{route}"}} {queries}')
+
+        family("sreport_db_rows_total", "counter", "Rows fetched by route.")
+        for method, route, _, _, _, _, _, rows in routes:
+            lines.append(f'sreport_db_rows_total{{method="{method}",route="{route}"}} {rows}')
+
+        caches = []
+        for route in app.routes:
+            cached = getattr(getattr(route, "endpoint", None), "cache", None)
+            if cached in CACHED_LIST:
+                for method in sorted(route.methods):
+                    caches.append((method, route.path, cached.stats()))
+
+        for name, kind, description in (
+                ("hits", "counter", "Cache hits by route."),
+                ("misses", "counter", "Cache misses by route."),
+                ("size", "gauge", "Cached entries by route.")):
+            family(f"sreport_cache_{name}" + ("_total" if kind == "counter" else ""), kind, description)
+            for method, path, stats in caches:
+                suffix = "_total" if kind == "counter" else ""
+                lines.append(f'sreport_cache_{name}{suffix}{{method="{method}",route="{path}"}} {stats[name]}')
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware: the request runs in the same context, so the
+    database hook finds its RequestStats
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current.set(stats)
+        status = 500
+        start = perf_counter()
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            current.reset(token)
+
+            route = route_of(scope)
+            if route is not None:
+                registry.observe(scope["method"], route, perf_counter() - start, status, stats)
+
+
+ROUTE_PATHS = {}  # endpoint: path
+
+
+def route_of(scope):
+    """
+    Path of the route that answered, None for a 404
+    """
+
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return None
+
+    if endpoint not in ROUTE_PATHS:
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                ROUTE_PATHS[endpoint] = route.path
+
+    return ROUTE_PATHS.get(endpoint)
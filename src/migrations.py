@@ -0,0 +1,188 @@
+"""
+Versioned schema migrations.
+
+The schema version lives in SQLite's ``PRAGMA user_version``. Each function
+decorated with ``@migration`` brings the database one version up and runs
+in its own transaction, so an existing ``database.sqlite`` is upgraded in
+place.
+
+The app only checks the schema version when it starts, unless
+SREPORT_AUTO_MIGRATE=1. Run ``python -m src.migrations`` to migrate and
+check that the hot queries use the indexes.
+"""
+
+from datetime import date
+
+from peewee import ModelIndex
+
+from .models import (ChangeLog, Group, MonthTotal, Preacher, PreacherIndex,
+                     PreacherTag, Report, ReportTag, Setting, Tag)
+from .rollup import rebuild
+
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """
+    Register {func} as the next schema version
+    """
+
+    MIGRATIONS.append(func)
+    return func
+
+
+def schema_version(db):
+    return db.pragma('user_version')
+
+
+def check_schema(db):
+    """
+    Fail unless {db} is at the last schema version
+    """
+
+    version = schema_version(db)
+
+    if version != len(MIGRATIONS):
+        raise RuntimeError(
+            f"{db.database} is at schema version {version} instead of "
+            f"{len(MIGRATIONS)}, run python -m src.migrations")
+
+
+def migrate(db):
+    """
+    Apply every migration newer than the database schema version
+    """
+
+    version = schema_version(db)
+
+    for n, func in enumerate(MIGRATIONS[version:], start=version + 1):
+        with db.atomic():
+            func(db)
+            db.pragma('user_version', n)
+
+    return len(MIGRATIONS)
+
+
+@migration
+def initial_schema(db):
+    # The tables of the first release, as its create_tables made them:
+    # only the indexes of their columns. The indexes of Meta.indexes and
+    # the later tables are added by the next migrations, after the data
+    # of an existing database is made to fit them.
+    for model in (Group, Tag, Preacher, PreacherTag, Report, ReportTag):
+        model._schema.create_table(safe=True)
+
+        for field in model._meta.sorted_fields:
+            if (field.index or field.unique) and not field.primary_key:
+                index = ModelIndex(model, (field,), unique=field.unique)
+                db.execute(model._schema._create_index(index, safe=True))
+
+
+@migration
+def composite_indexes(db):
+    # Report(month, preacher) becomes unique, keep the first report of
+    # each pair like get_report always did and drop the others.
+    duplicate = Report.alias()
+    duplicates = Report.select(Report.id).where(
+        Report.id > duplicate.select(duplicate.id)
+        .where(duplicate.month == Report.month)
+        .where(duplicate.preacher == Report.preacher)
+        .order_by(duplicate.id)
+        .limit(1)
+    )
+    duplicates = [_.id for _ in duplicates]
+
+    if duplicates:
+        ReportTag.delete().where(ReportTag.report.in_(duplicates)).execute()
+        Report.delete().where(Report.id.in_(duplicates)).execute()
+
+    for model in (PreacherTag, Report, ReportTag):
+        model._schema.create_indexes(safe=True)
+
+
+@migration
+def month_totals(db):
+    db.create_tables([MonthTotal])
+    rebuild()
+
+
+@migration
+def preacher_search_index(db):
+    PreacherIndex.create_table()
+
+    names = "firstname, lastname, display_name"
+    old = "old.firstname, old.lastname, old.display_name"
+    new = "new.firstname, new.lastname, new.display_name"
+
+    db.execute_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS preacher_index_insert AFTER INSERT ON preacher BEGIN
+            INSERT INTO preacherindex(rowid, {names}) VALUES (new.id, {new});
+        END""")
+    db.execute_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS preacher_index_delete AFTER DELETE ON preacher BEGIN
+            INSERT INTO preacherindex(preacherindex, rowid, {names}) VALUES ('delete', old.id, {old});
+        END""")
+    db.execute_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS preacher_index_update AFTER UPDATE ON preacher BEGIN
+            INSERT INTO preacherindex(preacherindex, rowid, {names}) VALUES ('delete', old.id, {old});
+            INSERT INTO preacherindex(rowid, {names}) VALUES (new.id, {new});
+        END""")
+
+    PreacherIndex._fts_cmd('rebuild')
+
+
+@migration
+def shared_state(db):
+    db.create_tables([Setting, ChangeLog])
+
+
+def query_plan(db, query):
+    sql, params = query.sql()
+    cursor = db.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params)
+
+    return [row[-1] for row in cursor]
+
+
+def check_indexes(db):
+    """
+    Assert that the hot queries are answered through an index
+    """
+
+    month = date.today().replace(day=1)
+    hot_queries = {
+        "report of the month": (
+            Report.select().where(Report.month == month),
+            "report_month_preacher_id"),
+        "report of a preacher": (
+            Report.select()
+            .where(Report.month == month)
+            .where(Report.preacher == 1),
+            "report_month_preacher_id"),
+        "tags of a report": (
+            ReportTag.select()
+            .where(ReportTag.report == 1)
+            .where(ReportTag.tag.in_([1, 2])),
+            "reporttag_report_id_tag_id"),
+        "tags of a preacher": (
+            PreacherTag.select()
+            .join(Preacher, on=(PreacherTag.preacher == Preacher.id))
+            .where(PreacherTag.preacher == 1)
+            .where((PreacherTag.start <= month) | (PreacherTag.start == None))
+            .where((PreacherTag.end >= month) | (PreacherTag.end == None)),
+            "preachertag_preacher_id_start_end"),
+    }
+
+    for name, (query, index) in hot_queries.items():
+        plan = query_plan(db, query)
+
+        assert any(index in detail for detail in plan), \
+            f"{name} does not use {index}: {plan}"
+
+
+if __name__ == "__main__":
+    from .models import db
+
+    print(f"schema version {migrate(db)}")
+    check_indexes(db)
+    print("hot queries use their indexes")
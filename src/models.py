@@ -1,10 +1,68 @@
-from typing import Optional
-from peewee import (BooleanField, CharField, DateField, ForeignKeyField,
-                    IntegerField, Model, SqliteDatabase)
-from pydantic import BaseModel as bm
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from typing import Dict, List, Optional
+from peewee import (BooleanField, CharField, DatabaseProxy, DateField,
+                    ForeignKeyField, IntegerField, Model, SqliteDatabase)
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
+from pydantic import BaseModel as bm, Field
 
 
-db = SqliteDatabase('database.sqlite', pragmas={'foreign_keys': 1})
+PRAGMAS = {
+    'foreign_keys': 1,
+    'journal_mode': 'wal',  # readers do not wait for the writer
+}
+
+current_database = ContextVar("database", default=None)
+
+
+class ContextDatabase(DatabaseProxy):
+    """
+    The database of the congregation of the current context, see
+    congregations.py, and the default one everywhere else.
+    """
+
+    __slots__ = ('default', 'hooks')
+
+    def __init__(self, default):
+        object.__setattr__(self, '_callbacks', [])
+        self.default = default
+        self.hooks = []
+
+    @property
+    def obj(self):
+        return current_database.get() or self.default
+
+    def initialize(self, obj):
+        self.default = obj
+
+        for callback in self._callbacks:
+            callback(obj)
+
+    def instrument(self, hook):
+        """
+        Call {hook} with the default database and every database opened
+        later, e.g. to wrap its execute_sql
+        """
+
+        self.hooks.append(hook)
+        hook(self.default)
+
+
+@contextmanager
+def using(database):
+    """
+    Bind the models to {database} in this context
+    """
+
+    token = current_database.set(database)
+    try:
+        yield database
+    finally:
+        current_database.reset(token)
+
+
+db = ContextDatabase(SqliteDatabase('database.sqlite', pragmas=PRAGMAS))
 
 
 class BaseModel(Model):
@@ -54,6 +112,37 @@ class Preacher(BaseModel):
         return f"{self.id} {self.display_name}"
 
 
+class PreacherIndex(FTS5Model):
+    """
+    Full text index of the preacher names, kept in sync by the triggers of
+    migrations.py. Accents and case are ignored.
+    """
+
+    rowid = RowIDField()  # Preacher.id
+
+    firstname = SearchField()
+    lastname = SearchField()
+    display_name = SearchField()
+
+    class Meta:
+        database = db
+        options = {
+            'content': 'preacher',
+            'content_rowid': 'id',
+            'prefix': '2 3',
+            'tokenize': 'unicode61 remove_diacritics 2',
+        }
+
+    @classmethod
+    def prefix_query(cls, search):
+        """
+        Every word of {search} as a prefix, e.g. 'ra jean' -> "ra"* "jean"*
+        """
+
+        words = search.replace('"', ' ').split()
+        return " ".join(f'"{word}"*' for word in words)
+
+
 class PreacherTag(BaseModel):
     preacher = ForeignKeyField(Preacher, backref="tags")
     tag = ForeignKeyField(Tag, backref="preachers")
@@ -61,6 +150,11 @@ class PreacherTag(BaseModel):
     start = DateField('%m %Y', null=True)
     end = DateField('%m %Y', null=True)
 
+    class Meta:
+        indexes = (
+            (('preacher', 'start', 'end'), False),
+        )
+
     def __str__(self):
         return f"{str(self.tag)} of {str(self.preacher)}"
 
@@ -80,6 +174,11 @@ class Report(BaseModel):
     # pionner = IntegerField(choices=[0, 1, 2])
     # Handled by ReportTag
 
+    class Meta:
+        indexes = (
+            (('month', 'preacher'), True),
+        )
+
     def __str__(self):
         month = str(self.month)
         preacher_name = self.preacher.display_name
@@ -91,18 +190,77 @@ class ReportTag(BaseModel):
     report = ForeignKeyField(Report, backref="tags")
     tag = ForeignKeyField(Tag, backref="reports")
 
+    class Meta:
+        indexes = (
+            (('report', 'tag'), False),
+        )
+
     def __str__(self):
         return f"{self.tag} of {self.report}"
 
 
-db.create_tables([
+class MonthTotal(BaseModel):
+    """
+    Report totals of a month, overall and per tag. See rollup.py
+    """
+
+    month = DateField('%m %Y')
+    tag = IntegerField(default=0)  # 0 for every report
+
+    number = IntegerField(default=0)
+
+    publication = IntegerField(default=0)
+    video = IntegerField(default=0)
+    hour = IntegerField(default=0)
+    visit = IntegerField(default=0)
+    study = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('month', 'tag'), True),
+        )
+
+    def __str__(self):
+        return f"{self.month} total of {self.tag or 'all'}"
+
+
+class Setting(BaseModel):
+    """
+    State shared by every worker, e.g. the working month
+    """
+
+    name = CharField(primary_key=True)
+    value = CharField()
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class ChangeLog(BaseModel):
+    """
+    Writes to replay on the caches of the other workers. See changes.py
+    """
+
+    origin = CharField()  # utils.INSTANCE of the writer
+    deps = CharField()  # comma separated names
+    scope = CharField()  # JSON
+
+    def __str__(self):
+        return f"{self.id} {self.deps} {self.scope}"
+
+
+MODELS = [
     Group,
     Tag,
     Preacher,
     PreacherTag,
     Report,
-    ReportTag
-])
+    ReportTag,
+    MonthTotal,
+    Setting,
+    ChangeLog
+]
+
 
 
 class PostReport(PostModel):
@@ -114,6 +272,54 @@ class PostReport(PostModel):
 
     note: Optional[str] = ""
 
+class PostMonthReport(PostReport):
+    preacher: int
+
+    tags: Optional[List[int]] = None  # None to keep the current tags
+
 class PostMonth(PostModel):
-    month: int
+    month: int = Field(..., ge=1, le=12)
     year: int
+
+
+# Response schemas, for the documentation: the routes answering with
+# FastJSONResponse send their cached bytes without validating them
+
+class TagData(bm):
+    id: int
+    name: Optional[str]
+    color: Optional[str]
+
+class PreacherData(bm):
+    id: int
+    firstname: Optional[str]
+    lastname: Optional[str]
+    display_name: Optional[str]
+
+    phone1: Optional[str]
+    phone2: Optional[str]
+    phone3: Optional[str]
+
+    address: Optional[str]
+
+    birth: Optional[date]
+    baptism: Optional[date]
+
+    group: Optional[int]
+
+    gender: Optional[bool]
+
+    tags: Optional[Dict[int, bool]]  # /api/preachers only
+
+class RecordCards(bm):
+    months: List[Dict[str, int]]
+    preachers: List[int]
+
+    publication: List[List[int]]
+    video: List[List[int]]
+    hour: List[List[int]]
+    visit: List[List[int]]
+    study: List[List[int]]
+
+    note: List[List[str]]
+    tags: List[List[List[int]]]
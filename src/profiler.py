@@ -0,0 +1,197 @@
+"""
+SQL profiler for debugging, off unless SREPORT_PROFILE=1.
+
+Every statement a request sends to the database is recorded with its
+time. A statement shape (its SQL without the parameters, IN lists folded)
+run PROFILE_REPEAT times or more in one request is flagged as a likely
+N+1, e.g. a foreign key loaded inside a loop, and a statement slower than
+PROFILE_SLOW_MS is logged with its EXPLAIN QUERY PLAN.
+
+The last PROFILE_KEEP traces are kept: the response gives its trace id in
+X-Trace-Id, and /api/debug/traces and /api/debug/traces/{id} return them
+as JSON.
+"""
+
+import logging
+import re
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from itertools import count
+from threading import Lock
+from time import perf_counter, time
+
+from fastapi import HTTPException
+
+from .config import PROFILE_KEEP, PROFILE_REPEAT, PROFILE_SLOW_MS
+
+
+logger = logging.getLogger("sreport.sql")
+
+current = ContextVar("sql_trace", default=None)
+
+IN_LIST = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+
+
+def shape(sql:str):
+    """
+    {sql} with its IN lists folded, the same for every length
+    """
+
+    return IN_LIST.sub("(?, ...)", sql)
+
+
+class Trace:
+    def __init__(self, trace_id:int, method:str, path:str):
+        self.id = trace_id
+        self.method = method
+        self.path = path
+        self.start = time()
+        self.duration = None
+        self.status = None
+        self.statements = []
+        self.lock = Lock()
+
+    def add(self, sql:str, params, seconds:float, plan=None):
+        with self.lock:
+            self.statements.append({
+                "sql": sql,
+                "params": [repr(_) for _ in (params or ())],
+                "ms": round(seconds * 1000, 3),
+                "plan": plan,
+            })
+
+    def repeated(self):
+        """
+        Shapes run at least PROFILE_REPEAT times, most run first
+        """
+
+        with self.lock:
+            shapes = Counter(shape(_["sql"]) for _ in self.statements)
+
+        return [
+            {"sql": sql, "count": n}
+            for sql, n in shapes.most_common() if n >= PROFILE_REPEAT
+        ]
+
+    def to_dict(self):
+        with self.lock:
+            statements = list(self.statements)
+
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "start": self.start,
+            "ms": self.duration and round(self.duration * 1000, 3),
+            "status": self.status,
+            "queries": len(statements),
+            "sql_ms": round(sum(_["ms"] for _ in statements), 3),
+            "repeated": self.repeated(),
+            "statements": statements,
+        }
+
+    def summary(self):
+        data = self.to_dict()
+        del data["statements"]
+
+        return data
+
+
+class Traces:
+    def __init__(self, keep:int=PROFILE_KEEP):
+        self.keep = keep
+        self.traces = OrderedDict()
+        self.ids = count(1)
+        self.lock = Lock()
+
+    def new(self, method:str, path:str):
+        trace = Trace(next(self.ids), method, path)
+
+        with self.lock:
+            self.traces[trace.id] = trace
+            while len(self.traces) > self.keep:
+                self.traces.popitem(last=False)
+
+        return trace
+
+    def get(self, trace_id:int):
+        with self.lock:
+            trace = self.traces.get(trace_id)
+
+        if trace is None:
+            raise HTTPException(status_code=404, detail=f"No trace {trace_id}")
+
+        return trace.to_dict()
+
+    def summaries(self):
+        with self.lock:
+            traces = list(self.traces.values())
+
+        return [trace.summary() for trace in reversed(traces)]
+
+
+traces = Traces()
+
+
+def instrument(database):
+    """
+    Record the statements of {database} in the trace of the current request
+    """
+
+    execute_sql = database.execute_sql
+
+    def traced(sql, params=None, *args, **kwargs):
+        trace = current.get()
+        if trace is None:
+            return execute_sql(sql, params, *args, **kwargs)
+
+        start = perf_counter()
+        cursor = execute_sql(sql, params, *args, **kwargs)
+        seconds = perf_counter() - start
+
+        plan = None
+        if seconds * 1000 >= PROFILE_SLOW_MS:
+            plan = [row[-1] for row in execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+            logger.warning(
+                "slow query %.1f ms in %s %s: %s\n%s",
+                seconds * 1000, trace.method, trace.path, sql, "\n".join(plan))
+
+        trace.add(sql, params, seconds, plan)
+
+        return cursor
+
+    database.execute_sql = traced
+
+
+class ProfilerMiddleware:
+    """
+    Pure ASGI middleware opening a trace per request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http") or scope["path"].startswith("/api/debug/"):
+            return await self.app(scope, receive, send)
+
+        trace = traces.new(scope["method"], scope["path"])
+        token = current.set(trace)
+        start = perf_counter()
+
+        async def send_trace_id(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", str(trace.id).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_trace_id)
+        finally:
+            current.reset(token)
+            trace.duration = perf_counter() - start
+
+            for repeated in trace.repeated():
+                logger.warning(
+                    "N+1? ran %d times in %s %s (trace %d): %s",
+                    repeated["count"], trace.method, trace.path, trace.id, repeated["sql"])
@@ -0,0 +1,55 @@
+"""
+JSON responses encoded once.
+
+FastAPI runs the value of a route through jsonable_encoder before
+json.dumps, which shows for the long lists. A cached GET route declared
+with response_class=FastJSONResponse skips both: its value is encoded
+straight to bytes, once per cache entry (see Cache.encoded), with orjson
+when it is installed (``poetry install -E fast``) and json otherwise.
+"""
+
+import json
+from datetime import date
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+
+def default(obj):
+    if isinstance(obj, date):
+        return obj.isoformat()
+
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    """
+    Same output as JSONResponse, without jsonable_encoder
+    """
+
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+        default=default,
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response taking already encoded bytes as well
+    """
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+
+        return dumps(content)
@@ -0,0 +1,117 @@
+"""
+Monthly report totals, overall and per tag, stored in MonthTotal.
+
+Saving one report, or its tags, adds the difference it makes to the
+totals of its month and of its tags; the bulk writes recompute the
+months they touched. The read endpoints answer from a couple of
+MonthTotal rows instead of summing every report. Run
+``python -m src.rollup`` to rebuild the whole table if it was ever left
+out of date.
+"""
+
+from peewee import EXCLUDED, Value, fn
+
+from .models import db, MonthTotal, Report, ReportTag, Tag
+
+
+COUNTERS = ("publication", "video", "hour", "visit", "study")
+FIELDS = [MonthTotal.month, MonthTotal.tag, MonthTotal.number] + \
+    [getattr(MonthTotal, name) for name in COUNTERS]
+
+
+def totals(month=None):
+    """
+    Queries of the totals of {month}, every month if None,
+    in the column order of FIELDS.
+    """
+
+    def counters():
+        return [fn.COUNT(Report.id)] + [fn.SUM(getattr(Report, name)) for name in COUNTERS]
+
+    overall = Report.select(Report.month, Value(0), *counters()) \
+        .group_by(Report.month)
+
+    # a report counts once per tag, even if the tag was set twice
+    per_tag = Report.select(Report.month, Tag.id, *counters()) \
+        .join(Tag, on=fn.EXISTS(
+            ReportTag.select(ReportTag.id)
+            .where(ReportTag.report == Report.id)
+            .where(ReportTag.tag == Tag.id))) \
+        .group_by(Report.month, Tag.id)
+
+    if month is not None:
+        overall = overall.where(Report.month == month)
+        per_tag = per_tag.where(Report.month == month)
+
+    return overall, per_tag
+
+
+def refresh_month(month):
+    """
+    Recompute the totals of {month}, a date
+    """
+
+    with db.atomic():
+        MonthTotal.delete().where(MonthTotal.month == month).execute()
+
+        for query in totals(month):
+            MonthTotal.insert_from(query, FIELDS).execute()
+
+
+def add_to_totals(month, tags, number:int, counters:dict):
+    """
+    Add {number} reports and {counters} to the totals of {month} for each
+    tag of {tags}, 0 for every report. Totals left without any report are
+    dropped, like a recomputation would.
+    """
+
+    tags = list(tags)
+
+    if not tags:
+        return
+
+    rows = [
+        {"month": month, "tag": tag, "number": number, **counters}
+        for tag in tags
+    ]
+
+    MonthTotal.insert_many(rows) \
+        .on_conflict(
+            conflict_target=[MonthTotal.month, MonthTotal.tag],
+            update={
+                getattr(MonthTotal, name): getattr(MonthTotal, name) + getattr(EXCLUDED, name)
+                for name in ("number",) + COUNTERS
+            }) \
+        .execute()
+
+    MonthTotal.delete() \
+        .where(MonthTotal.month == month) \
+        .where(MonthTotal.tag.in_(tags)) \
+        .where(MonthTotal.number <= 0) \
+        .execute()
+
+
+def rebuild():
+    with db.atomic():
+        MonthTotal.delete().execute()
+
+        for query in totals():
+            MonthTotal.insert_from(query, FIELDS).execute()
+
+
+def month_total(month, tag:int=0):
+    """
+    Totals of {month} for the reports with {tag}, 0 for every report
+    """
+
+    total = MonthTotal.select().where(MonthTotal.month == month).where(MonthTotal.tag == tag).first()
+
+    return {
+        name: getattr(total, name) if total is not None else 0
+        for name in ("number",) + COUNTERS
+    }
+
+
+if __name__ == "__main__":
+    rebuild()
+    print(f"{MonthTotal.select().count()} month totals")
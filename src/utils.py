@@ -1,17 +1,81 @@
-from functools import wraps, lru_cache
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from hashlib import blake2b
+from inspect import signature
+from threading import RLock
+from time import monotonic
+from uuid import uuid4
 
 
 CACHED_LIST = []
 
+# partition of the current context, e.g. the congregation: the entries
+# and versions of a partition never serve another one
+partition = ContextVar("cache_partition", default="")
+
+# (partition, dep): number of writes to it seen by this process, see
+# etag(). Partition None counts the writes to every partition.
+VERSIONS = {}
+VERSIONS_LOCK = RLock()
+# versions are only comparable within one process
+INSTANCE = uuid4().hex
+
+# called with (deps, scope) for every write, inside its transaction when
+# there is one, e.g. to tell the other processes, see changes.py
+UPDATE_LISTENERS = []
+
 
 class Cache:
     """
     Like LRU_Cache but can be updated
+
+    Every entry remembers the scope it was computed for (e.g. one preacher
+    and one month), so a write only drops the entries it may have changed.
+    The partition of the context (see partition) is part of every key and
+    every scope.
+
+    It is safe to share between threads: concurrent calls with the same
+    arguments wait for a single computation, and a value computed while a
+    write invalidates its scope is handed to the callers already waiting
+    but never stored.
     """
 
-    def __init__(self, deps:list, updates:list=[]):
+    MAXSIZE = 256
+    TTL = None
+
+    def __init__(self, deps:list, updates:list=[], scope=None, maxsize:int=None, ttl:float=None, atomic=None):
+        """
+        :param deps: what the cached values depend on
+        :param updates: what a call changes, such function is never cached
+        :param scope: function of the call arguments returning a dict
+            {dimension: value or set of values}, e.g. {"preacher": 1}
+        :param maxsize: max number of entries, least recently used go first
+        :param ttl: seconds before an entry expires, None for never
+        :param atomic: transaction of an update call, e.g. db.atomic: the
+            UPDATE_LISTENERS run in it, the caches are invalidated once it
+            is committed
+        """
+
         self.deps = deps
         self.updates = updates
+        self.scope = scope
+        self.maxsize = maxsize or self.MAXSIZE
+        self.ttl = ttl if ttl is not None else self.TTL
+        self.atomic = atomic or nullcontext
+
+        self.entries = OrderedDict()
+        self.encodings = {}  # key: (value, encoded value), see encoded()
+        self.pending = {}  # key: (Future, scope or None until known) being computed
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.invalidations = 0
+        self.coalesced = 0
 
         CACHED_LIST.append(self)
 
@@ -20,11 +84,60 @@ class Cache:
         This is the real decorator
         """
 
+        self.signature = signature(func)
+
         @wraps(func)
-        @lru_cache()
         def wrapped(*args, **kwargs):
-            result = func(*args, **kwargs)
-            update_cache(self.updates)
+            arguments = self.arguments(args, kwargs)
+
+            if self.updates:
+                with self.atomic():
+                    result = func(*args, **kwargs)
+                    scope = notify_update(self.updates, **self.scope_of(arguments))
+
+                invalidate_caches(self.updates, **scope)
+                return result
+
+            key = self.key_of(arguments)
+
+            with self.lock:
+                try:
+                    return self.get(key)
+                except KeyError:
+                    pass
+
+                if key in self.pending:
+                    future, _ = self.pending[key]
+                    self.coalesced += 1
+                    leader = False
+                else:
+                    future = Future()
+                    self.pending[key] = (future, None)
+                    leader = True
+
+            if not leader:
+                return future.result()
+
+            try:
+                scope = self.normalize(self.scope_of(arguments))
+
+                with self.lock:
+                    if self.pending.get(key, (None,))[0] is future:
+                        self.pending[key] = (future, scope)
+
+                result = func(*args, **kwargs)
+
+            except BaseException as e:
+                with self.lock:
+                    self.release(key, future)
+                future.set_exception(e)
+                raise
+
+            with self.lock:
+                if self.release(key, future):
+                    self.set(key, result, scope)
+            future.set_result(result)
+
             return result
 
         wrapped.cache = self
@@ -32,24 +145,215 @@ class Cache:
         self.func = wrapped
         return self.func
 
+    def release(self, key, future):
+        """
+        Forget the computation of {key}.
+        Return False if a write invalidated it meanwhile.
+        """
+
+        if self.pending.get(key, (None,))[0] is future:
+            del self.pending[key]
+            return True
+
+        return False
+
+    def arguments(self, args, kwargs):
+        """
+        Call arguments by name, so f(1) and f(id=1) share the same entry
+        """
+
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+
+        return bound.arguments
+
+    def key_of(self, arguments):
+        return (partition.get(),) + tuple(arguments.values())
+
+    def scope_of(self, arguments):
+        scope = {} if self.scope is None else self.scope(**arguments)
+        scope["partition"] = partition.get()
+
+        return scope
+
+    def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+
+        value, scope, expires = entry
+
+        if (expires is not None) and (expires <= monotonic()):
+            del self.entries[key]
+            self.encodings.pop(key, None)
+            self.expired += 1
+            self.misses += 1
+            raise KeyError(key)
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    @staticmethod
+    def normalize(scope):
+        return {
+            dim: frozenset(val) if isinstance(val, (set, frozenset)) else frozenset([val])
+            for dim, val in scope.items()
+        }
+
+    def set(self, key, value, scope):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+
+        self.entries[key] = (value, scope, expires)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            old_key, _ = self.entries.popitem(last=False)
+            self.encodings.pop(old_key, None)
+            self.evictions += 1
+
+    def invalidate(self, **scope):
+        """
+        Drop the entries that overlap {scope}, every entry if it is empty
+        """
+
+        def overlap(entry_scope):
+            for dim, val in scope.items():
+                if (val is not None) and (dim in entry_scope) and (val not in entry_scope[dim]):
+                    return False
+            return True
+
+        with self.lock:
+            stale = [key for key, (_, entry_scope, _) in self.entries.items() if overlap(entry_scope)]
+
+            for key in stale:
+                del self.entries[key]
+                self.encodings.pop(key, None)
+
+            self.invalidations += len(stale)
+
+            # running computations may have read the old data
+            for key, (_, pending_scope) in list(self.pending.items()):
+                if (pending_scope is None) or overlap(pending_scope):
+                    del self.pending[key]
+
     def update(self):
-        self.func.cache_clear()
+        self.invalidate()
+
+    def encoded(self, encode, *args, **kwargs):
+        """
+        The value of the call encoded by {encode}, e.g. to JSON bytes,
+        encoded once for as long as the value stays cached
+        """
+
+        value = self.func(*args, **kwargs)
+        key = self.key_of(self.arguments(args, kwargs))
+
+        with self.lock:
+            encoding = self.encodings.get(key)
+
+        # a recomputed value is a new object, so identity tells if it changed
+        if (encoding is not None) and (encoding[0] is value):
+            return encoding[1]
+
+        data = encode(value)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None) and (entry[0] is value):
+                self.encodings[key] = (value, data)
+
+        return data
+
+    def etag(self, args=(), kwargs={}):
+        """
+        Entity tag of the value for these call arguments: it changes as soon
+        as one of the deps is written, without calling the function.
+        """
+
+        key = self.key_of(self.arguments(args, kwargs))
+
+        with VERSIONS_LOCK:
+            versions = tuple(
+                (VERSIONS.get((key[0], dep), 0), VERSIONS.get((None, dep), 0))
+                for dep in self.deps)
+
+        digest = blake2b(repr((INSTANCE, self.func.__name__, key, versions)).encode(), digest_size=12)
+
+        return f'"{digest.hexdigest()}"'
 
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "encoded": len(self.encodings),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+                "coalesced": self.coalesced,
+                "pending": len(self.pending),
+            }
+
+
+def cache_stats():
+    return {cached.func.__name__: cached.stats() for cached in CACHED_LIST}
+
+
+def update_cache(deps, **scope):
+    """
+    Invalidate the caches depending on {deps} after a write, here and,
+    through UPDATE_LISTENERS, elsewhere
+
+    :param scope: only drop entries of this scope, e.g. preacher=1.
+        The partition defaults to the one of the context, None for all.
+    """
+
+    scope = notify_update(deps, **scope)
+    invalidate_caches(deps, **scope)
+
+
+def notify_update(deps, **scope):
+    """
+    Call the UPDATE_LISTENERS for a write of {deps}, return its scope
+    """
+
+    scope.setdefault("partition", partition.get())
+
+    for listener in UPDATE_LISTENERS:
+        listener(deps if isinstance(deps, list) else [deps], scope)
+
+    return scope
+
+
+def invalidate_caches(deps, **scope):
+    """
+    update_cache in this process only
+    """
 
-def update_cache(deps):
     def _in(to_check, in_me):
         for _ in in_me:
             if (to_check == _) or isinstance(to_check, _):
                 return True
         return False
 
-    if isinstance(deps, list):
-        for dep in deps:
-            for cached in CACHED_LIST:
-                if _in(dep, cached.deps):
-                    cached.update()
+    if not isinstance(deps, list):
+        deps = [deps]
 
-    else:
+    for dep in deps:
         for cached in CACHED_LIST:
-            if _in(deps, cached.deps):
-                cached.update()
+            if _in(dep, cached.deps):
+                cached.invalidate(**scope)
+
+    # after the invalidation, so a new etag never comes with an old value
+    with VERSIONS_LOCK:
+        for dep in deps:
+            key = (scope.get("partition"), dep)
+            VERSIONS[key] = VERSIONS.get(key, 0) + 1